@@ -1,18 +1,23 @@
 import frappe
-from frappe.utils import flt, formatdate
-import re
-
-def normalise_cnic(value: str | None) -> str:
-    """
-    Normalize CNIC/NTN/Tax IDs by removing non-digits (hyphens, spaces, etc.)
-    Examples:
-      "31303-9589654-7" -> "3130395896547"
-      " 31303 9589654 7 " -> "3130395896547"
-    """
-    if not value:
-        return ""
-    return re.sub(r"\D", "", str(value)).strip()
-
+from fbr_e_invoicing.api.payload_mapping import SALES_INVOICE
+from fbr_e_invoicing.api.payload_core import (
+    InvoiceRecord,
+    LineRecord,
+    build_payloads,
+    canonical_json,
+    get_buyer_tax_id,
+    get_invoice_scenario_id,
+    payload_hash,
+)
+from fbr_e_invoicing.api.fbr_cache import (
+    get_item_tax_rate,
+    get_item_tax_rates,
+    get_line_scenario_ids,
+    get_party_address_text,
+    get_party_address_texts,
+    get_party_fields,
+    get_party_fields_many,
+)
 
 @frappe.whitelist()
 def build_fbr_payload(sales_invoice_name: str):
@@ -20,162 +25,135 @@ def build_fbr_payload(sales_invoice_name: str):
     Build FBR payload for a Sales Invoice per provided mapping.
     Returns a dict (JSON-serializable).
     """
-    doc = frappe.get_doc('Sales Invoice', sales_invoice_name)
+    return build_fbr_payload_from_doc(frappe.get_doc('Sales Invoice', sales_invoice_name))
 
+def build_fbr_payload_from_doc(doc):
+    """Build the FBR payload from an in-memory Sales Invoice document"""
     # --- Party helpers ---
-    if frappe.db.get_value('Customer', doc.customer, 'tax_id'):
-        buyer_tax_id = frappe.db.get_value('Customer', doc.customer, 'tax_id') if doc.customer else None
-    elif doc.nic:
-        buyer_tax_id = normalise_cnic(doc.nic)
-    elif doc.ntn:
-        buyer_tax_id = doc.ntn
-    buyer_name = frappe.db.get_value('Customer', doc.customer, 'customer_name') if doc.customer else None
-    buyer_province = doc.tax_category
-    buyer_address = _get_party_address_text('Customer', doc.customer)
-    invoice_type = "Debit Note" if getattr(doc, "is_debit_note", 0) else "Sale Invoice"
-    seller_tax_id = frappe.db.get_value('Company', doc.company, 'tax_id') if doc.company else None
-    seller_name = doc.company
-    seller_province = doc.custom_province
-    seller_address = _get_party_address_text('Company', doc.company)
-    buyer_registration_type = "Registered" if buyer_tax_id else "Unregistered"
-
-    # --- Invoice-level fields ---
-    payload = {
-        "invoiceType": invoice_type,
-        "invoiceDate": formatdate(doc.posting_date, "yyyy-mm-dd"),
-        "sellerNTNCNIC": (seller_tax_id or ""),
-        "sellerBusinessName": (seller_name or ""),
-        "sellerProvince": (seller_province or ""),
-        "sellerAddress": (seller_address or ""),
-        "buyerNTNCNIC": (buyer_tax_id or ""),
-        "buyerBusinessName": (buyer_name or ""),
-        "buyerProvince": (buyer_province or ""),
-        "buyerAddress": (buyer_address or ""),
-        "buyerRegistrationType": buyer_registration_type,
-        "invoiceRefNo": "",
-        "scenarioId": get_scenario_id(doc.items[0].custom_sale_type),
-        "items": []
+    customer = get_party_fields('Customer', doc.customer)
+    ctx = {
+        "seller_tax_id": get_party_fields('Company', doc.company).tax_id,
+        "seller_address": get_party_address_text('Company', doc.company),
+        "buyer_tax_id": get_buyer_tax_id(customer.tax_id, doc.get("nic"), doc.get("ntn")),
+        "buyer_name": customer.customer_name,
+        "buyer_address": get_party_address_text('Customer', doc.customer),
+        "scenario_id": get_invoice_scenario_id(get_line_scenario_ids(row.custom_sale_type for row in doc.items or [])),
     }
 
     # --- Items mapping ---
-    for row in (doc.items or []):
-        tax_rate = _first_item_tax_rate(row.item_tax_template)
-        value_excl_st = flt(row.rate)
-        sales_tax_applicable = round((tax_rate * value_excl_st) / 100.0, 2)
-
-        item_entry = {
-            "hsCode": (row.custom_hs_code or ""),
-            "productDescription": (row.description or row.item_name or ""),
-            "rate": format_rate(tax_rate),
-            "uoM": (row.stock_uom or ""),
-            "quantity": flt(row.qty),
-            "totalValues": 0.00,
-            "valueSalesExcludingST": value_excl_st,
-            "fixedNotifiedValueOrRetailPrice": 0.00,
-            "salesTaxApplicable": sales_tax_applicable,
-            "salesTaxWithheldAtSource": 0.00,
-            "extraTax": 0.00,
-            "furtherTax": 0.00,
-            "sroScheduleNo": "", 
-            "fedPayable": 0.00,
-            "discount": abs(flt(row.discount_amount or 0.0)),
-            "saleType": (row.custom_sale_type or ""),
-            "sroItemSerialNo": ""
-        }
-        payload["items"].append(item_entry)
+    items = doc.items or []
+    return SALES_INVOICE.build(doc, ctx, items, [{"tax_rate": get_item_tax_rate(row.item_tax_template)} for row in items])
 
-    return payload
+def freeze_fbr_payload(doc, method=None):
+    """
+    Called on Sales Invoice before_submit.
+    Stores the payload as canonical JSON with its hash so that every
+    (re)submission sends exactly these bytes without rebuilding them.
+    """
+    if not doc.get("custom_submit_to_fbr"):
+        return
 
-def format_rate(tax_rate):
-    value = flt(tax_rate)
-    # If the number is a whole number (e.g. 18.0), format without decimals
-    if value.is_integer():
-        return f"{int(value)}%"
-    else:
-        return f"{value}%"
-    
+    body = canonical_json(build_fbr_payload_from_doc(doc))
+    doc.custom_payload = body
+    doc.custom_payload_hash = payload_hash(body)
 
-def get_scenario_id(sale_type: str) -> str:
+def backfill_fbr_payloads(batch_size=500, processes=None):
     """
-    Fetch scenario_id from FBR Sale Type doctype
-    based on the given sale_type.
-    Returns empty string if not found.
+    Freeze the payloads of submitted Sales Invoices that do not have one yet
+    (e.g. submitted before payloads were frozen). Payloads are built over
+    `processes` worker processes; run with
+    `bench --site <site> execute fbr_e_invoicing.api.build_fbr_payload.backfill_fbr_payloads --kwargs "{'processes': 4}"`.
     """
-    if not sale_type:
-        return ""
-
-    try:
-        scenario_id = frappe.db.get_value(
-            "FBR Sale Type",   # Doctype name
-            {"name": sale_type},   # or use {"sale_type": sale_type} if field differs
-            "scenario_id"
+    total = 0
+    while True:
+        names = frappe.get_all(
+            "Sales Invoice",
+            filters={"docstatus": 1, "custom_submit_to_fbr": 1, "custom_payload": ["is", "not set"]},
+            pluck="name",
+            limit=batch_size
         )
-        return scenario_id or ""
-    except Exception:
-        return ""
+        if not names:
+            return total
+
+        for name, payload in build_fbr_payloads(names, processes=processes).items():
+            store_fbr_payload(name, payload)
+        frappe.db.commit()
+        total += len(names)
+
+def store_fbr_payload(sales_invoice_name, payload):
+    """Freeze the payload of an already submitted Sales Invoice; returns the stored string"""
+    body = canonical_json(payload)
+    frappe.db.set_value(
+        "Sales Invoice",
+        sales_invoice_name,
+        {"custom_payload": body, "custom_payload_hash": payload_hash(body)},
+        update_modified=False
+    )
+    return body
 
-  
-def _get_party_address_text(link_doctype: str, link_name: str) -> str:
+def build_fbr_payloads(sales_invoice_names, processes=None):
     """
-    Find Address via Dynamic Link child table:
-      1) Get Address names from Dynamic Link where link_doctype/link_name match
-      2) From those Address docs, prefer primary (is_primary_address), else latest
-      3) Return "address_line1, address_line2, city, state, pincode"
+    Batch variant of build_fbr_payload for many Sales Invoices.
+    Loads headers, items, parties, addresses, tax rates and scenario ids with
+    a fixed number of IN (...) queries regardless of how many invoices or
+    lines there are, then builds the payloads in payload_core (over
+    `processes` worker processes if given). Returns {sales_invoice_name:
+    payload}; names that do not exist are left out.
     """
-    if not (link_doctype and link_name):
-        return ""
-
-    # 1) Get parent Address names from Dynamic Link
-    address_names = frappe.get_all(
-        "Dynamic Link",
-        filters={
-            "parenttype": "Address",
-            "link_doctype": link_doctype,
-            "link_name": link_name,
-        },
-        pluck="parent",   # returns list of Address names
-        limit=50
+    names = list(dict.fromkeys(sales_invoice_names or []))
+    if not names:
+        return {}
+
+    # nic/ntn are not shipped by this app; read them only where a site has them
+    meta = frappe.get_meta("Sales Invoice")
+    invoices = frappe.get_all(
+        "Sales Invoice",
+        filters={"name": ["in", names]},
+        fields=[
+            "name", "customer", "company", "posting_date",
+            "tax_category", "custom_province", "is_debit_note",
+            *[field for field in ("nic", "ntn") if meta.has_field(field)]
+        ]
     )
+    if not invoices:
+        return {}
 
-    if not address_names:
-        return ""
-
-    # 2) Pull those Address docs; prefer primary, else newest, and skip disabled
-    addresses = frappe.get_all(
-        "Address",
-        filters={
-            "name": ["in", address_names],
-            "disabled": 0,
-        },
+    items_by_invoice = {}
+    for row in frappe.get_all(
+        "Sales Invoice Item",
+        filters={"parenttype": "Sales Invoice", "parent": ["in", [inv.name for inv in invoices]]},
         fields=[
-            "name", "address_line1", "address_line2",
-            "city", "state", "pincode", "is_primary_address", "creation"
+            "parent", "item_tax_template", "rate", "custom_hs_code", "description",
+            "item_name", "stock_uom", "qty", "discount_amount", "custom_sale_type"
         ],
-        order_by="is_primary_address desc, creation desc",
-        limit=1
-    )
-
-    if not addresses:
-        return ""
-
-    a = addresses[0]
-
-    # 3) Compose a readable single-line address
-    parts = [a.get("address_line1"), a.get("address_line2"), a.get("city"), a.get("state"), a.get("pincode")]
-    return ", ".join([p for p in parts if p])
+        order_by="parent asc, idx asc"
+    ):
+        items_by_invoice.setdefault(row.parent, []).append(row)
 
+    party_keys = list(
+        {("Customer", inv.customer) for inv in invoices if inv.customer}
+        | {("Company", inv.company) for inv in invoices if inv.company}
+    )
+    parties = get_party_fields_many(party_keys)
+    addresses = get_party_address_texts(party_keys)
+
+    all_rows = [row for rows in items_by_invoice.values() for row in rows]
+    tax_rates = get_item_tax_rates({row.item_tax_template for row in all_rows if row.item_tax_template})
+
+    records = []
+    for inv in invoices:
+        customer = parties.get(("Customer", inv.customer)) or frappe._dict()
+        rows = items_by_invoice.get(inv.name, [])
+
+        ctx = {
+            "seller_tax_id": (parties.get(("Company", inv.company)) or frappe._dict()).tax_id,
+            "seller_address": addresses.get(("Company", inv.company), ""),
+            "buyer_tax_id": get_buyer_tax_id(customer.tax_id, inv.get("nic"), inv.get("ntn")),
+            "buyer_name": customer.customer_name,
+            "buyer_address": addresses.get(("Customer", inv.customer), ""),
+            "scenario_id": get_invoice_scenario_id(get_line_scenario_ids(row.custom_sale_type for row in rows)),
+        }
+        lines = [LineRecord(tax_rate=tax_rates.get(row.item_tax_template, 0.0), **row) for row in rows]
+        records.append(InvoiceRecord("Sales Invoice", inv.name, dict(inv), ctx, lines))
 
-def _first_item_tax_rate(item_tax_template_name: str) -> float:
-    """
-    From Item Tax Template, get first taxes row's tax_rate.
-    Returns 0.0 if not found.
-    """
-    if not item_tax_template_name:
-        return 0.0
-    try:
-        itt = frappe.get_doc("Item Tax Template", item_tax_template_name)
-        if getattr(itt, "taxes", None) and len(itt.taxes) > 0:
-            return flt(itt.taxes[0].tax_rate)
-    except Exception:
-        pass
-    return 0.0
+    return build_payloads(records, processes=processes)
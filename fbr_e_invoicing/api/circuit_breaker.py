@@ -0,0 +1,114 @@
+import frappe
+import hashlib
+from frappe.utils import cint
+from requests.exceptions import RequestException
+
+# Decide whether a request may go out. Returns "closed" (normal traffic),
+# "probe" (cooldown over, this caller sends the single half-open probe) or
+# "open" (skip the request). A probe that never reports back is replaced
+# after another cooldown.
+ALLOW_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local cooldown = tonumber(ARGV[1])
+
+local state = redis.call('HGET', KEYS[1], 'state')
+if not state or state == 'closed' then
+    return 'closed'
+end
+
+local opened_at = tonumber(redis.call('HGET', KEYS[1], 'opened_at')) or 0
+if now < opened_at + cooldown then
+    return 'open'
+end
+
+local probe_at = tonumber(redis.call('HGET', KEYS[1], 'probe_at')) or 0
+if state == 'open' or now >= probe_at + cooldown then
+    redis.call('HSET', KEYS[1], 'state', 'half_open', 'probe_at', tostring(now))
+    return 'probe'
+end
+return 'open'
+"""
+
+# Record the outcome of a request. A success closes the breaker and clears
+# the failure streak; a failure while open/half-open (re)opens it, otherwise
+# it opens once ARGV[2] consecutive failures are reached.
+RECORD_SCRIPT = """
+if ARGV[1] == 'success' then
+    redis.call('DEL', KEYS[1])
+    return 'closed'
+end
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HGET', KEYS[1], 'state')
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', 1)
+if state == 'open' or state == 'half_open' or failures >= tonumber(ARGV[2]) then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', tostring(now))
+    return 'open'
+end
+return 'closed'
+"""
+
+# Hand back an unused probe permit: a half-open breaker whose probe sent no
+# request lets the next caller probe right away. No-op once the probe's
+# outcome was recorded (closed or re-opened).
+RELEASE_PROBE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'state') == 'half_open' then
+    redis.call('HSET', KEYS[1], 'probe_at', '0')
+    return 1
+end
+return 0
+"""
+
+class FBRCircuitOpen(frappe.ValidationError):
+    pass
+
+class CircuitBreaker:
+    """Redis-backed circuit breaker for one FBR endpoint, shared by all workers"""
+
+    def __init__(self, redis_client, endpoint, threshold, cooldown):
+        self.redis = redis_client
+        self.key = f"fbr:circuit:{hashlib.sha256(endpoint.encode()).hexdigest()[:16]}"
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def allow_request(self):
+        """Return "closed", "probe" or "open" for the next request"""
+        return frappe.safe_decode(self.redis.eval(ALLOW_SCRIPT, 1, self.key, self.cooldown))
+
+    def release_probe(self):
+        """Return a "probe" permit whose request never went out"""
+        self.redis.eval(RELEASE_PROBE_SCRIPT, 1, self.key)
+
+    def record_success(self):
+        self.redis.eval(RECORD_SCRIPT, 1, self.key, "success", self.threshold)
+
+    def record_failure(self):
+        self.redis.eval(RECORD_SCRIPT, 1, self.key, "failure", self.threshold)
+
+    def record(self, outcome):
+        """Record a response or send exception; returns True if it counted as a failure"""
+        if is_transport_failure(outcome):
+            self.record_failure()
+            return True
+        if not isinstance(outcome, Exception):
+            self.record_success()
+        return False
+
+def is_transport_failure(outcome):
+    """Whether PRAL was unreachable or failed on its side (no response or HTTP 5xx)"""
+    if isinstance(outcome, Exception):
+        return isinstance(outcome, RequestException)
+    return outcome.status_code >= 500
+
+def get_circuit_breaker(fbr_settings):
+    """Circuit breaker for the configured endpoint, or None when disabled"""
+    threshold = cint(getattr(fbr_settings, "circuit_breaker_threshold", 0))
+    api_endpoint = (fbr_settings.api_endpoint or "").strip()
+    if threshold <= 0 or not api_endpoint:
+        return None
+
+    cooldown = cint(getattr(fbr_settings, "circuit_breaker_cooldown", 0)) or 60
+    return CircuitBreaker(frappe.cache(), api_endpoint, threshold, cooldown)
@@ -0,0 +1,65 @@
+"""Bounded-concurrency batch submission to the FBR endpoint.
+
+This module deliberately has no frappe imports: the HTTP calls run in
+worker threads where no site context exists. Callers prepare payloads and
+headers up front and interpret the returned responses afterwards.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def submit_batch_async(items, session, api_endpoint, concurrency=4, timeout=(10.0, 30.0), verify=True, before_send=None):
+    """Post many prepared payloads at once over one pooled session.
+
+    `items` is a list of dicts with `key`, `body` (the JSON string to post)
+    and optional `headers`.
+    `before_send`, if given, is called in the sending thread right before
+    each request (e.g. to acquire a rate limit token).
+    Returns a list of `(key, outcome)` in input order, where outcome is the
+    `requests.Response` or the exception raised while sending. Both carry
+    `total_seconds`, the wall time of the POST itself (after before_send).
+    """
+    if not items:
+        return []
+
+    concurrency = max(1, int(concurrency or 1))
+    return asyncio.run(_submit_all(items, session, api_endpoint, concurrency, timeout, verify, before_send))
+
+
+def _send(session, api_endpoint, item, timeout, verify, before_send):
+    if before_send:
+        before_send()
+    start = time.perf_counter()
+    try:
+        resp = session.post(
+            api_endpoint,
+            data=item["body"],
+            headers={"Content-Type": "application/json", **(item.get("headers") or {})},
+            timeout=timeout,
+            verify=verify,
+        )
+    except Exception as e:
+        e.total_seconds = time.perf_counter() - start
+        raise
+    resp.total_seconds = time.perf_counter() - start
+    return resp
+
+
+async def _submit_all(items, session, api_endpoint, concurrency, timeout, verify, before_send):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fbr-submit") as executor:
+
+        async def submit_one(item):
+            async with semaphore:
+                try:
+                    resp = await loop.run_in_executor(
+                        executor, _send, session, api_endpoint, item, timeout, verify, before_send
+                    )
+                    return item["key"], resp
+                except Exception as e:
+                    return item["key"], e
+
+        return await asyncio.gather(*(submit_one(item) for item in items))
@@ -0,0 +1,363 @@
+import frappe
+import time
+from collections import OrderedDict
+from frappe.utils import flt
+
+# How often a process re-reads a namespace's generation from Redis
+GENERATION_CHECK_SECONDS = 5
+
+# Lookups between pushes of the hit/miss counters to Redis
+STATS_FLUSH_EVERY = 100
+
+# Lifetime of a namespace's Redis hash; bounds how long a value written back
+# by a racing reader can outlive its invalidation
+CACHE_TTL_SECONDS = 3600
+
+class FBRCache:
+    """Process-local LRU in front of a site-scoped frappe.cache() hash.
+
+    On a miss, values are loaded in bulk with `loader(keys) -> {key: value}`;
+    keys the loader does not return are cached as `default`. Each namespace
+    has a generation counter in Redis: invalidation bumps it, and every other
+    process drops its local copies within GENERATION_CHECK_SECONDS. The
+    Redis hash expires CACHE_TTL_SECONDS after it is first filled.
+    """
+
+    def __init__(self, namespace, loader, default=None, maxsize=2048):
+        self.namespace = namespace
+        self.loader = loader
+        self.default = default
+        self.maxsize = maxsize
+        self._local = OrderedDict()
+        self._generations = {}
+        self._stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+        self._pending_lookups = 0
+
+    @property
+    def redis_key(self):
+        return f"fbr_cache:{self.namespace}"
+
+    @property
+    def generation_key(self):
+        return frappe.cache().make_key(f"fbr_cache_generation:{self.namespace}")
+
+    def get(self, key):
+        return self.get_many([key]).get(key, self.default)
+
+    def get_many(self, keys):
+        """Return {key: value} for all keys, loading misses in one call"""
+        keys = list(keys)
+        self._check_generation()
+        site = frappe.local.site
+
+        result, missing = {}, []
+        for key in dict.fromkeys(k for k in keys if k):
+            local_key = (site, key)
+            if local_key in self._local:
+                self._local.move_to_end(local_key)
+                result[key] = self._local[local_key]
+                self._stats["local_hits"] += 1
+            else:
+                missing.append(key)
+
+        if missing:
+            to_load = []
+            for key in missing:
+                value = frappe.cache().hget(self.redis_key, key)
+                if value is None:
+                    to_load.append(key)
+                else:
+                    result[key] = value
+                    self._stats["redis_hits"] += 1
+
+            if to_load:
+                loaded = self.loader(to_load) or {}
+                for key in to_load:
+                    value = loaded.get(key, self.default)
+                    frappe.cache().hset(self.redis_key, key, value)
+                    result[key] = value
+                self._set_expiry()
+                self._stats["misses"] += len(to_load)
+
+            for key in missing:
+                self._remember((site, key), result[key])
+
+        self._count_lookups(len(keys))
+        return result
+
+    def invalidate(self, keys=None):
+        """Evict `keys` (or everything) here, in Redis and in every other process.
+
+        Called from doc_events, i.e. before the change commits: a process
+        that misses in between still reads the old row and writes it back.
+        The eviction is therefore repeated once the transaction commits.
+        """
+        keys = None if keys is None else list(keys)
+        self._evict(keys)
+        frappe.db.after_commit.add(lambda: self._evict(keys))
+
+    def _evict(self, keys):
+        if keys is None:
+            frappe.cache().delete_key(self.redis_key)
+        else:
+            for key in keys:
+                frappe.cache().hdel(self.redis_key, key)
+
+        self._generations[frappe.local.site] = (frappe.cache().incr(self.generation_key), time.monotonic())
+        self._drop_local(keys)
+
+    def stats(self):
+        """Hit/miss counters aggregated over all processes of this site"""
+        self._flush_stats()
+        raw = frappe.cache().execute_command("HGETALL", frappe.cache().make_key(f"fbr_cache_stats:{self.namespace}")) or {}
+        stats = {frappe.safe_decode(k): int(v) for k, v in raw.items()}
+        lookups = sum(stats.values())
+        hits = stats.get("local_hits", 0) + stats.get("redis_hits", 0)
+        stats["hit_rate"] = round(hits * 100.0 / lookups, 2) if lookups else 0
+        return stats
+
+    def _set_expiry(self):
+        # Only a hash without a TTL gets one, so refills do not extend it
+        redis_key = frappe.cache().make_key(self.redis_key)
+        if frappe.cache().ttl(redis_key) == -1:
+            frappe.cache().expire(redis_key, CACHE_TTL_SECONDS)
+
+    def _remember(self, local_key, value):
+        self._local[local_key] = value
+        self._local.move_to_end(local_key)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+    def _drop_local(self, keys=None):
+        site = frappe.local.site
+        for local_key in list(self._local):
+            if local_key[0] == site and (keys is None or local_key[1] in keys):
+                del self._local[local_key]
+
+    def _check_generation(self):
+        site = frappe.local.site
+        seen = self._generations.get(site)
+        if seen and time.monotonic() - seen[1] < GENERATION_CHECK_SECONDS:
+            return
+
+        generation = int(frappe.cache().get(self.generation_key) or 0)
+        if seen and seen[0] != generation:
+            self._drop_local()
+        self._generations[site] = (generation, time.monotonic())
+
+    def _count_lookups(self, count):
+        self._pending_lookups += count
+        if self._pending_lookups >= STATS_FLUSH_EVERY:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        key = frappe.cache().make_key(f"fbr_cache_stats:{self.namespace}")
+        pipe = frappe.cache().pipeline()
+        for field, value in self._stats.items():
+            if value:
+                pipe.hincrby(key, field, value)
+        pipe.execute()
+        self._stats = dict.fromkeys(self._stats, 0)
+        self._pending_lookups = 0
+
+# --- Item Tax Template rates ---
+
+def _load_item_tax_rates(names):
+    """First taxes row's tax_rate for each Item Tax Template, in one query"""
+    rates = {}
+    for row in frappe.get_all(
+        "Item Tax Template Detail",
+        filters={"parenttype": "Item Tax Template", "parent": ["in", names]},
+        fields=["parent", "tax_rate"],
+        order_by="parent asc, idx asc"
+    ):
+        rates.setdefault(row.parent, flt(row.tax_rate))
+    return rates
+
+item_tax_rate_cache = FBRCache("item_tax_rate", _load_item_tax_rates, default=0.0)
+
+def get_item_tax_rate(item_tax_template_name: str) -> float:
+    """
+    From Item Tax Template, get first taxes row's tax_rate.
+    Returns 0.0 if not found.
+    """
+    if not item_tax_template_name:
+        return 0.0
+    return item_tax_rate_cache.get(item_tax_template_name)
+
+def get_item_tax_rates(item_tax_template_names) -> dict:
+    """Returns {template name: first taxes row's tax_rate} for many templates"""
+    return item_tax_rate_cache.get_many(item_tax_template_names or [])
+
+def clear_item_tax_rate_cache(doc, method=None, *args):
+    """doc_event: evict an Item Tax Template's rate when it changes"""
+    item_tax_rate_cache.invalidate(_doc_names(doc, method, args))
+
+def _doc_names(doc, method, args):
+    """The doc's name, plus its old name in after_rename (called with old, new, merge)"""
+    names = [doc.name]
+    if method == "after_rename" and args:
+        names.append(args[0])
+    return names
+
+# --- Party addresses ---
+
+def _party_key(link_doctype, link_name):
+    return f"{link_doctype}::{link_name}"
+
+def _load_party_address_texts(keys):
+    """
+    Find each party's Address via the Dynamic Link child table, preferring the
+    primary (is_primary_address), else the latest enabled address, and
+    compose "address_line1, address_line2, city, state, pincode".
+    Uses one Dynamic Link and one Address query for all keys.
+    """
+    parties = {tuple(key.split("::", 1)) for key in keys}
+
+    links = frappe.get_all(
+        "Dynamic Link",
+        filters={
+            "parenttype": "Address",
+            "link_doctype": ["in", list({dt for dt, _ in parties})],
+            "link_name": ["in", list({dn for _, dn in parties})],
+        },
+        fields=["parent", "link_doctype", "link_name"]
+    )
+    links = [link for link in links if (link.link_doctype, link.link_name) in parties]
+    if not links:
+        return {}
+
+    # Preferred (primary, then newest) enabled address first
+    addresses = frappe.get_all(
+        "Address",
+        filters={"name": ["in", list({link.parent for link in links})], "disabled": 0},
+        fields=["name", "address_line1", "address_line2", "city", "state", "pincode"],
+        order_by="is_primary_address desc, creation desc"
+    )
+    rank = {a.name: idx for idx, a in enumerate(addresses)}
+    addresses = {a.name: a for a in addresses}
+
+    texts, best = {}, {}
+    for link in links:
+        key = _party_key(link.link_doctype, link.link_name)
+        if link.parent in rank and (key not in best or rank[link.parent] < best[key]):
+            best[key] = rank[link.parent]
+            a = addresses[link.parent]
+            parts = [a.get("address_line1"), a.get("address_line2"), a.get("city"), a.get("state"), a.get("pincode")]
+            texts[key] = ", ".join([p for p in parts if p])
+
+    return texts
+
+party_address_cache = FBRCache("party_address", _load_party_address_texts, default="")
+
+def get_party_address_text(link_doctype: str, link_name: str) -> str:
+    """Single-line address of a Customer/Company (or any linked party), "" if none"""
+    if not (link_doctype and link_name):
+        return ""
+    return party_address_cache.get(_party_key(link_doctype, link_name))
+
+def get_party_address_texts(parties) -> dict:
+    """Takes (link_doctype, link_name) pairs and returns {(link_doctype, link_name): address text}"""
+    parties = [(dt, dn) for dt, dn in parties if dt and dn]
+    texts = party_address_cache.get_many([_party_key(dt, dn) for dt, dn in parties])
+    return {(dt, dn): texts.get(_party_key(dt, dn), "") for dt, dn in parties}
+
+def clear_party_address_cache(doc, method=None, *args):
+    """doc_event on Address: evict every party the address is (or was) linked to"""
+    links = list(doc.get("links") or [])
+    before = doc.get_doc_before_save()
+    if before:
+        links += list(before.get("links") or [])
+
+    keys = {_party_key(link.link_doctype, link.link_name) for link in links if link.link_doctype and link.link_name}
+    if keys:
+        party_address_cache.invalidate(keys)
+
+# --- Party master fields ---
+
+# Columns of each party doctype used by validation and the payload builders
+PARTY_FIELDS = {
+    "Customer": ["tax_id", "customer_name", "custom_province"],
+    "Company": ["tax_id", "custom_province"],
+}
+
+def _load_party_fields(keys):
+    """PARTY_FIELDS of each party, in one query per doctype"""
+    names_by_doctype = {}
+    for key in keys:
+        link_doctype, link_name = key.split("::", 1)
+        names_by_doctype.setdefault(link_doctype, []).append(link_name)
+
+    values = {}
+    for link_doctype, names in names_by_doctype.items():
+        for row in frappe.get_all(
+            link_doctype,
+            filters={"name": ["in", names]},
+            fields=["name"] + PARTY_FIELDS[link_doctype]
+        ):
+            values[_party_key(link_doctype, row.pop("name"))] = dict(row)
+    return values
+
+party_fields_cache = FBRCache("party_fields", _load_party_fields, default={})
+
+def get_party_fields(link_doctype: str, link_name: str):
+    """PARTY_FIELDS of a Customer/Company as a frappe._dict (empty if not found)"""
+    if not (link_doctype and link_name):
+        return frappe._dict()
+    return frappe._dict(party_fields_cache.get(_party_key(link_doctype, link_name)))
+
+def get_party_fields_many(parties) -> dict:
+    """Takes (link_doctype, link_name) pairs and returns {(link_doctype, link_name): frappe._dict}"""
+    parties = [(dt, dn) for dt, dn in parties if dt and dn]
+    values = party_fields_cache.get_many([_party_key(dt, dn) for dt, dn in parties])
+    return {(dt, dn): frappe._dict(values.get(_party_key(dt, dn)) or {}) for dt, dn in parties}
+
+def clear_party_fields_cache(doc, method=None, *args):
+    """doc_event on Customer/Company: evict the party's cached fields"""
+    party_fields_cache.invalidate([_party_key(doc.doctype, name) for name in _doc_names(doc, method, args)])
+
+# --- FBR Sale Type scenario ids ---
+
+# The whole table (a few dozen rows) is cached as one map under this key
+SALE_TYPE_MAP_KEY = "all"
+
+def _load_sale_type_scenarios(keys):
+    return {
+        SALE_TYPE_MAP_KEY: {
+            row.name: row.scenario_id or ""
+            for row in frappe.get_all("FBR Sale Type", fields=["name", "scenario_id"])
+        }
+    }
+
+sale_type_scenario_cache = FBRCache("sale_type_scenario", _load_sale_type_scenarios, default={})
+
+def get_scenario_ids() -> dict:
+    """{FBR Sale Type name: scenario_id} for every sale type; treat as read-only"""
+    return sale_type_scenario_cache.get(SALE_TYPE_MAP_KEY)
+
+def get_scenario_id(sale_type: str) -> str:
+    """
+    Fetch scenario_id from FBR Sale Type doctype
+    based on the given sale_type.
+    Returns empty string if not found.
+    """
+    if not sale_type:
+        return ""
+    return get_scenario_ids().get(sale_type, "")
+
+def get_line_scenario_ids(sale_types) -> list:
+    """scenario_id of each line's sale type, in order ("" where unknown)"""
+    scenario_ids = get_scenario_ids()
+    return [scenario_ids.get(sale_type, "") if sale_type else "" for sale_type in sale_types]
+
+def clear_sale_type_cache(doc=None, method=None, *args):
+    """doc_event on FBR Sale Type: reload the whole map on next use"""
+    sale_type_scenario_cache.invalidate()
+
+@frappe.whitelist()
+def get_cache_stats():
+    """Hit rates of the FBR lookup caches"""
+    frappe.only_for("System Manager")
+    return {cache.namespace: cache.stats() for cache in (
+        item_tax_rate_cache, party_address_cache, party_fields_cache, sale_type_scenario_cache
+    )}
@@ -1,7 +1,91 @@
 import frappe
 import json
+import os
+import random
+import socket
+import time
 from datetime import datetime, timedelta
-from frappe.utils import now, add_to_date, get_datetime
+from frappe.utils import now, now_datetime, add_to_date, get_datetime, cint, flt
+from fbr_e_invoicing.api.circuit_breaker import get_circuit_breaker
+
+# How long a worker may hold claimed rows before they are considered abandoned
+# (the minimum; see get_queue_lease_seconds)
+QUEUE_LEASE_SECONDS = 300
+
+# Longest sleep urllib3 takes between HTTP retries (its backoff cap)
+HTTP_RETRY_SLEEP_ALLOWANCE = 120
+
+# Retry limit for rows that do not carry their own max_retries
+DEFAULT_MAX_RETRIES = 5
+
+# Exponential backoff bounds (seconds) for failed submissions
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 3600
+
+# Completed rows stay in the live queue this long before the daily job archives them
+QUEUE_ARCHIVE_AFTER_DAYS = 1
+
+# Rows moved per archive transaction
+QUEUE_ARCHIVE_CHUNK_SIZE = 1000
+
+# FBR Queue columns copied to FBR Queue Archive
+QUEUE_ARCHIVE_COLUMNS = (
+    "name", "creation", "modified", "modified_by", "owner", "docstatus",
+    "document_type", "document_name", "priority", "status", "retry_count", "max_retries",
+    "error_message", "fbr_response", "created_at", "last_retry_at", "completed_at",
+)
+
+# Hot queue statements, shared with query_plans so its EXPLAIN check runs
+# exactly what the queue runs. Claiming appends FOR UPDATE SKIP LOCKED.
+CLAIM_QUEUE_ITEMS_SQL = """
+    SELECT name
+    FROM `tabFBR Queue`
+    WHERE status = 'Pending'
+        AND next_retry_at <= %(now)s
+        AND retry_count < IFNULL(NULLIF(max_retries, 0), %(max_retries)s)
+        {name_condition}
+    ORDER BY priority desc, created_at asc
+    LIMIT %(limit)s
+"""
+
+RENEW_LEASE_SQL = """
+    UPDATE `tabFBR Queue`
+    SET lease_expires_at = %(lease_expires_at)s
+    WHERE status = 'Processing' AND worker_id = %(worker_id)s
+"""
+
+# status is assigned before retry_count, so it still sees the old count
+REQUEUE_EXPIRED_LEASES_SQL = """
+    UPDATE `tabFBR Queue`
+    SET status = IF(retry_count + 1 >= IFNULL(NULLIF(max_retries, 0), %(max_retries)s), 'Failed', 'Pending'),
+        retry_count = retry_count + 1,
+        error_message = 'Worker stopped before finishing (lease expired)',
+        last_retry_at = %(now)s, next_retry_at = %(now)s,
+        worker_id = NULL, lease_expires_at = NULL
+    WHERE status = 'Processing' AND lease_expires_at < %(now)s
+"""
+
+RETRY_FAILED_ITEMS_SQL = """
+    UPDATE `tabFBR Queue`
+    SET status = 'Pending', error_message = '', next_retry_at = %(now)s
+    WHERE status = 'Failed' AND retry_count < IFNULL(NULLIF(max_retries, 0), %(max_retries)s)
+"""
+
+ARCHIVE_CHUNK_SQL = """
+    SELECT name FROM `tabFBR Queue`
+    WHERE status = 'Completed' AND completed_at < %(cutoff)s
+    ORDER BY completed_at
+    LIMIT %(limit)s
+"""
+
+# Error recorded on queue rows of invoices that are no longer submitted
+CANCELLED_ERROR = "Invoice was cancelled (or is not submitted); not sent to FBR"
+
+# Drain loop defaults: wall-clock budget per run and batch sizing bounds
+DEFAULT_QUEUE_TIME_BUDGET = 600
+QUEUE_BATCH_TARGET_SECONDS = 60
+MIN_QUEUE_BATCH_SIZE = 5
+MAX_QUEUE_BATCH_SIZE = 500
 
 @frappe.whitelist()
 def add_to_queue(doctype, docname, status="Pending", error_message="", priority=5):
@@ -15,12 +99,21 @@ def add_to_queue(doctype, docname, status="Pending", error_message="", priority=
         })
         
         if existing:
-            # Update existing queue item
             queue_doc = frappe.get_doc("FBR Queue", existing)
+
+            # A live worker still holds this row; leave it alone
+            if queue_doc.status == "Processing" and queue_doc.lease_expires_at \
+                    and get_datetime(queue_doc.lease_expires_at) > now_datetime():
+                return {"success": True, "queue_id": queue_doc.name}
+
+            # Update existing queue item
             queue_doc.status = status
+            queue_doc.worker_id = ""
+            queue_doc.lease_expires_at = None
             queue_doc.error_message = error_message
             queue_doc.retry_count = (queue_doc.retry_count or 0) + 1
             queue_doc.last_retry_at = now()
+            queue_doc.next_retry_at = now()
             queue_doc.save(ignore_permissions=True)
         else:
             # Create new queue item
@@ -32,7 +125,8 @@ def add_to_queue(doctype, docname, status="Pending", error_message="", priority=
                 "priority": priority,
                 "error_message": error_message,
                 "retry_count": 0,
-                "created_at": now()
+                "created_at": now(),
+                "next_retry_at": now()
             })
             queue_doc.insert(ignore_permissions=True)
         
@@ -43,114 +137,468 @@ def add_to_queue(doctype, docname, status="Pending", error_message="", priority=
         frappe.log_error(f"Error adding to FBR queue: {str(e)}", "FBR Queue")
         return {"success": False, "error": str(e)}
 
+def enqueue_on_submit(doc, method=None):
+    """Queue a submitted invoice in the same transaction and submit it right after commit"""
+    if not doc.get("custom_submit_to_fbr") or doc.get("custom_fbr_invoice_number"):
+        return
+
+    # Consolidated Sales Invoices repeat POS Invoices already reported on their
+    # own submit; returns are not supported by the payload yet
+    if doc.get("is_consolidated") or doc.get("is_return"):
+        return
+
+    queue_name = frappe.db.exists("FBR Queue", {
+        "document_type": doc.doctype,
+        "document_name": doc.name,
+        "status": ["in", ["Pending", "Processing"]]
+    })
+
+    if not queue_name:
+        # Outbox row: written together with the invoice, no commit here
+        queue_doc = frappe.new_doc("FBR Queue")
+        queue_doc.update({
+            "document_type": doc.doctype,
+            "document_name": doc.name,
+            "status": "Pending",
+            "priority": 5,
+            "retry_count": 0,
+            "created_at": now(),
+            "next_retry_at": now()
+        })
+        queue_doc.insert(ignore_permissions=True)
+        queue_name = queue_doc.name
+
+    # The scheduled drain only sweeps up whatever this job could not submit
+    frappe.enqueue(
+        "fbr_e_invoicing.api.fbr_queue.process_queue",
+        queue="short",
+        enqueue_after_commit=True,
+        names=[queue_name]
+    )
+
+def cancel_queued_submission(doc, method=None):
+    """on_cancel: fail the invoice's Pending queue row so it is never sent.
+
+    A row already claimed by a worker is caught by the worker's docstatus
+    check before its request goes out.
+    """
+    frappe.db.sql("""
+        UPDATE `tabFBR Queue`
+        SET status = 'Failed', error_message = %s, modified = %s
+        WHERE document_type = %s AND document_name = %s AND status = 'Pending'
+    """, (CANCELLED_ERROR, now(), doc.doctype, doc.name))
+
+def get_next_retry_at(retry_count):
+    """Exponential backoff with jitter for the given attempt number"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** max(cint(retry_count) - 1, 0)))
+    # Keep half the delay fixed and randomise the rest so retries spread out
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return add_to_date(now_datetime(), seconds=delay)
+
+def get_worker_id():
+    """Identify the current worker process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def get_queue_lease_seconds(fbr_settings):
+    """Lease that outlasts one wave in the worst case.
+
+    A request may wait up to read_timeout for a rate limit token, then take
+    connect + read timeout per attempt over http_max_retries retries, with
+    a backoff sleep between attempts. The lease is twice that, and never
+    shorter than QUEUE_LEASE_SECONDS.
+    """
+    connect_timeout = flt(fbr_settings.get("connect_timeout")) or 10.0
+    read_timeout = flt(fbr_settings.get("read_timeout")) or 30.0
+    retries = cint(fbr_settings.get("http_max_retries"))
+    worst_case = read_timeout + (connect_timeout + read_timeout) * (retries + 1) + HTTP_RETRY_SLEEP_ALLOWANCE * retries
+    return max(QUEUE_LEASE_SECONDS, int(worst_case * 2))
+
+def renew_lease(worker_id, lease_seconds=QUEUE_LEASE_SECONDS):
+    """Heartbeat: extend the lease on every row this worker still holds"""
+    frappe.db.sql(RENEW_LEASE_SQL, {
+        "lease_expires_at": add_to_date(now_datetime(), seconds=lease_seconds),
+        "worker_id": worker_id,
+    })
+    frappe.db.commit()
+
+def requeue_expired_leases():
+    """Move rows whose worker stopped heartbeating back to Pending.
+
+    A reaped row counts as an attempt, so an invoice that keeps killing its
+    worker ends up Failed after max_retries instead of looping forever.
+    """
+    try:
+        frappe.db.sql(REQUEUE_EXPIRED_LEASES_SQL, {"max_retries": DEFAULT_MAX_RETRIES, "now": now()})
+        frappe.db.commit()
+
+    except Exception as e:
+        frappe.log_error(f"Error requeuing expired FBR queue leases: {str(e)}", "FBR Queue Reaper")
+
+def claim_queue_items(limit, worker_id, names=None):
+    """Atomically claim up to `limit` Pending rows for this worker.
+
+    Rows are locked with SKIP LOCKED so concurrent workers never pick the same
+    row, then flipped to Processing with the worker id and a lease expiry.
+    Pass `names` to claim only those rows.
+    """
+    values = {"now": now(), "max_retries": DEFAULT_MAX_RETRIES, "limit": cint(limit)}
+    name_condition = ""
+    if names:
+        name_condition = "AND name IN %(names)s"
+        values["names"] = tuple(names)
+
+    names = frappe.db.sql(
+        CLAIM_QUEUE_ITEMS_SQL.format(name_condition=name_condition) + "FOR UPDATE SKIP LOCKED",
+        values,
+        pluck=True
+    )
+
+    if not names:
+        frappe.db.commit()
+        return []
+
+    frappe.db.sql("""
+        UPDATE `tabFBR Queue`
+        SET status = 'Processing', worker_id = %s, lease_expires_at = %s, modified = %s
+        WHERE name IN %s
+    """, (worker_id, add_to_date(now_datetime(), seconds=QUEUE_LEASE_SECONDS), now(), tuple(names)))
+    frappe.db.commit()
+
+    return frappe.get_all(
+        "FBR Queue",
+        filters={"name": ["in", names], "worker_id": worker_id},
+        fields=["name", "document_type", "document_name", "priority", "retry_count", "max_retries"],
+        order_by="priority desc, created_at asc"
+    )
+
 @frappe.whitelist()
-def process_queue(limit=50):
+def process_queue(limit=50, names=None):
     """Process pending items in the FBR queue"""
     try:
-        # Get pending queue items
-        queue_items = frappe.get_all(
-            "FBR Queue",
-            filters={
-                "status": "Pending",
-                "retry_count": ["<", 5]  # Max 5 retries
-            },
-            fields=["name", "document_type", "document_name", "priority", "retry_count"],
-            order_by="priority desc, created_at asc",
-            limit=limit
-        )
+        worker_id = get_worker_id()
+        if isinstance(names, str):
+            names = json.loads(names)
+
+        # Claim pending queue items for this worker
+        queue_items = claim_queue_items(limit, worker_id, names)
         
         processed_count = 0
+        released = []
+
+        fbr_settings = frappe.get_single("FBR E-Inv Setup")
+        breaker = get_circuit_breaker(fbr_settings)
+        lease_seconds = get_queue_lease_seconds(fbr_settings)
+
+        # Items are submitted in waves of `concurrency` parallel requests
+        concurrency = cint(fbr_settings.get("submission_concurrency")) or 1
         
-        for item in queue_items:
+        position = 0
+        while position < len(queue_items):
+            wave = concurrency
+            permit = None
+
+            # While PRAL is down, hand the rest back without using up retries
+            if breaker:
+                permit = breaker.allow_request()
+                if permit == "open":
+                    released = [item.name for item in queue_items[position:]]
+                    break
+                if permit == "probe":
+                    wave = 1
+
+            chunk = queue_items[position:position + wave]
+            position += len(chunk)
+
+            # Every wave starts with a full lease, long enough for its worst case
+            renew_lease(worker_id, lease_seconds)
+
             try:
-                # Mark as processing
-                frappe.db.set_value("FBR Queue", item.name, "status", "Processing")
-                frappe.db.commit()
-                
-                # Process the item
-                result = process_queue_item(item)
+                results = process_queue_batch(chunk, concurrency, breaker)
+            except Exception as e:
+                results = {item.name: {"success": False, "error": str(e)} for item in chunk}
+                frappe.log_error(f"Error processing queue batch: {str(e)}", "FBR Queue Processing")
+
+            # A probe item that needed no request (already accepted, payload
+            # error) recorded nothing; let the next wave probe instead
+            if permit == "probe":
+                breaker.release_probe()
+
+            # The wave's invoice writes and queue outcomes are committed together
+            completed, retries, failed = [], [], []
+            for item in chunk:
+                result = results.get(item.name) or {"success": False, "error": "Unknown error"}
                 
                 if result["success"]:
-                    # Mark as completed
-                    frappe.db.set_value("FBR Queue", item.name, {
-                        "status": "Completed",
-                        "completed_at": now(),
-                        "error_message": ""
-                    })
+                    completed.append(item.name)
                     processed_count += 1
                 else:
-                    # Mark as failed or pending for retry
+                    # Mark as failed or schedule the next retry with backoff
                     retry_count = item.retry_count + 1
-                    if retry_count >= 5:
-                        status = "Failed"
-                    else:
-                        status = "Pending"
-                        
-                    frappe.db.set_value("FBR Queue", item.name, {
-                        "status": status,
+                    outcome = {
+                        "name": item.name,
                         "retry_count": retry_count,
-                        "last_retry_at": now(),
                         "error_message": result.get("error", "Unknown error")
-                    })
-                
-            except Exception as e:
-                # Mark as failed
-                frappe.db.set_value("FBR Queue", item.name, {
-                    "status": "Failed",
-                    "error_message": str(e),
-                    "retry_count": item.retry_count + 1
-                })
-                frappe.log_error(f"Error processing queue item {item.name}: {str(e)}", "FBR Queue Processing")
-                
+                    }
+                    # `final` results (e.g. a cancelled invoice) are never retried
+                    if result.get("final") or retry_count >= (item.max_retries or DEFAULT_MAX_RETRIES):
+                        failed.append(outcome)
+                    else:
+                        outcome["next_retry_at"] = get_next_retry_at(retry_count)
+                        retries.append(outcome)
+
+            write_back_queue_outcomes(worker_id, completed, retries, failed)
+            frappe.db.commit()
+
+        if released:
+            released_until = add_to_date(now_datetime(), seconds=breaker.cooldown)
+            write_back_queue_outcomes(worker_id, released=released, released_until=released_until)
             frappe.db.commit()
         
-        # Clean up old completed items (older than 30 days)
-        cleanup_old_queue_items()
-        
-        return {"processed_count": processed_count}
+        return {
+            "processed_count": processed_count,
+            "claimed_count": len(queue_items),
+            "circuit_open": bool(released)
+        }
         
     except Exception as e:
         frappe.log_error(f"Error processing FBR queue: {str(e)}", "FBR Queue")
-        return {"processed_count": 0, "error": str(e)}
+        return {"processed_count": 0, "claimed_count": 0, "error": str(e)}
+
+def drain_queue(time_budget=None, batch_size=20):
+    """Process batches until the queue is empty or the time budget runs out.
+
+    The next batch is sized from the per-item latency observed so far, so a
+    batch takes roughly QUEUE_BATCH_TARGET_SECONDS and never overshoots the
+    remaining budget by much.
+    """
+    time_budget = cint(time_budget) or get_queue_time_budget()
+    batch_size = cint(batch_size) or MIN_QUEUE_BATCH_SIZE
+    started = time.monotonic()
+    summary = {"batches": 0, "claimed": 0, "processed": 0}
+
+    while True:
+        remaining = time_budget - (time.monotonic() - started)
+        if remaining <= 0:
+            break
+
+        batch_started = time.monotonic()
+        result = process_queue(limit=batch_size)
+        claimed = result.get("claimed_count", 0)
+        if result.get("error") or result.get("circuit_open") or not claimed:
+            break
+
+        summary["batches"] += 1
+        summary["claimed"] += claimed
+        summary["processed"] += result.get("processed_count", 0)
+
+        per_item = (time.monotonic() - batch_started) / claimed
+        target = min(QUEUE_BATCH_TARGET_SECONDS, remaining)
+        batch_size = max(MIN_QUEUE_BATCH_SIZE, min(MAX_QUEUE_BATCH_SIZE, int(target / per_item) if per_item else MAX_QUEUE_BATCH_SIZE))
+
+    summary["elapsed"] = round(time.monotonic() - started, 2)
+    frappe.logger("fbr_e_invoicing").info(f"FBR queue drain finished: {summary}")
+    return summary
+
+def get_queue_time_budget():
+    """Wall-clock seconds a scheduled drain run may take"""
+    return cint(frappe.db.get_single_value("FBR E-Inv Setup", "queue_time_budget")) or DEFAULT_QUEUE_TIME_BUDGET
+
+def _case_sql(field, outcomes):
+    """Build `field = CASE name WHEN .. THEN .. END` for a batch of outcomes"""
+    sql = f"{field} = CASE name {' '.join(['WHEN %s THEN %s'] * len(outcomes))} END"
+    values = []
+    for outcome in outcomes:
+        values.extend([outcome["name"], outcome[field]])
+    return sql, values
+
+def write_back_queue_outcomes(worker_id, completed=None, retries=None, failed=None, released=None, released_until=None):
+    """Write a batch of queue outcomes with one UPDATE per status group.
+
+    `released` rows were never sent (circuit open) and go back to Pending
+    until `released_until` without counting a retry. Only rows still held by
+    `worker_id` are touched, so a row that was reaped and claimed by another
+    worker is never overwritten.
+    """
+    timestamp = now()
+
+    if released:
+        frappe.db.sql("""
+            UPDATE `tabFBR Queue`
+            SET status = 'Pending', next_retry_at = %s,
+                error_message = 'Skipped: FBR endpoint unavailable (circuit open)',
+                worker_id = NULL, lease_expires_at = NULL, modified = %s
+            WHERE name IN %s AND worker_id = %s
+        """, (released_until, timestamp, tuple(released), worker_id))
+
+    if completed:
+        frappe.db.sql("""
+            UPDATE `tabFBR Queue`
+            SET status = 'Completed', completed_at = %s, error_message = '',
+                worker_id = NULL, lease_expires_at = NULL, modified = %s
+            WHERE name IN %s AND worker_id = %s
+        """, (timestamp, timestamp, tuple(completed), worker_id))
+
+    for status, outcomes, fields in (
+        ("Pending", retries, ("retry_count", "error_message", "next_retry_at")),
+        ("Failed", failed, ("retry_count", "error_message")),
+    ):
+        if not outcomes:
+            continue
+
+        assignments, values = [], []
+        for field in fields:
+            sql, field_values = _case_sql(field, outcomes)
+            assignments.append(sql)
+            values.extend(field_values)
+
+        frappe.db.sql(f"""
+            UPDATE `tabFBR Queue`
+            SET status = %s, {", ".join(assignments)}, last_retry_at = %s,
+                worker_id = NULL, lease_expires_at = NULL, modified = %s
+            WHERE name IN %s AND worker_id = %s
+        """, [status, *values, timestamp, timestamp, tuple(o["name"] for o in outcomes), worker_id])
+
+def get_queued_document_state(queue_item):
+    """docstatus and custom_fbr_status of the queued invoice, or None if it is gone"""
+    return frappe.db.get_value(
+        queue_item.document_type, queue_item.document_name, ["docstatus", "custom_fbr_status"], as_dict=True
+    )
+
+def process_queue_batch(queue_items, concurrency, breaker=None):
+    """Submit queue items concurrently and return {queue name: result}.
+
+    Payloads are prepared and responses applied in this thread; only the HTTP
+    calls run concurrently over the worker's pooled session.
+    """
+    from fbr_e_invoicing.api.fbr_async import submit_batch_async
+    from fbr_e_invoicing.api.rate_limiter import get_rate_limiter
+    from fbr_e_invoicing.api.submission_metrics import get_request_metrics
+    from fbr_e_invoicing.api.fbr_submission import (
+        get_fbr_request_headers,
+        get_fbr_request_options,
+        get_fbr_session,
+        get_invoice_bodies,
+        get_invoice_body,
+        log_fbr_submission,
+        parse_fbr_response,
+    )
+
+    results = {}
+    prepared = []
+    items_by_name = {item.name: item for item in queue_items}
+
+    # Read all stored payloads of the wave with a fixed number of queries per doctype
+    bodies_by_doctype = {}
+    for doctype in {item.document_type for item in queue_items}:
+        try:
+            bodies_by_doctype[doctype] = get_invoice_bodies(
+                doctype, [item.document_name for item in queue_items if item.document_type == doctype]
+            )
+        except Exception:
+            bodies_by_doctype[doctype] = {}
+
+    for item in queue_items:
+        try:
+            state = get_queued_document_state(item)
+
+            # A worker that dies after its wave was committed but before the
+            # row was handed back leaves an accepted invoice in the queue; it
+            # must never be sent twice
+            if state and state.custom_fbr_status == "Valid":
+                results[item.name] = {"success": True}
+                continue
+
+            # Cancelled (or never submitted) invoices are never sent
+            if state and state.docstatus != 1:
+                results[item.name] = {"success": False, "error": CANCELLED_ERROR, "final": True}
+                continue
+
+            # Fall back to the single-document path, which raises a readable error
+            body = bodies_by_doctype[item.document_type].get(item.document_name) \
+                or get_invoice_body(item.document_type, item.document_name)
+
+            prepared.append({
+                "key": item.name,
+                "body": body,
+                "headers": get_fbr_request_headers(item.document_name, item.document_type, is_retry=True)
+            })
+        except Exception as e:
+            log_fbr_submission(item.document_type, item.document_name, "", {"error": str(e)}, "Error")
+            results[item.name] = {"success": False, "error": str(e)}
+
+    if not prepared:
+        return results
 
-def process_queue_item(queue_item):
-    """Process a single queue item"""
     try:
-        from fbr_e_invoicing.api.fbr_submission import submit_single_invoice
-        
-        # Submit the invoice
-        response = submit_single_invoice(
-            queue_item.document_type, 
-            queue_item.document_name, 
-            is_retry=True
+        fbr_settings = frappe.get_single("FBR E-Inv Setup")
+        options = get_fbr_request_options(fbr_settings)
+        limiter = get_rate_limiter(fbr_settings)
+        responses = submit_batch_async(
+            prepared,
+            get_fbr_session(fbr_settings),
+            options["api_endpoint"],
+            concurrency=concurrency,
+            timeout=options["timeout"],
+            verify=options["verify"],
+            before_send=limiter.acquire if limiter else None
         )
-        
-        # Update the document with the response
-        doc = frappe.get_doc(queue_item.document_type, queue_item.document_name)
-        
-        if queue_item.document_type == "Sales Invoice":
-            doc.custom_fbr_response = json.dumps(response, indent=2)
-            doc.custom_fbr_invoice_number = response.get("invoiceNumber", "")
-            doc.custom_fbr_datetime = response.get("dated", "")
-            doc.custom_fbr_status = response.get("validationResponse", {}).get("status", "")
-        else:  # POS Invoice
-            doc.custom_fbr_responce = json.dumps(response, indent=2)
-            doc.custom_fbr_invoice_number = response.get("invoiceNumber", "")
-            doc.custom_fbr_datetime = response.get("dated", "")
-            doc.custom_fbr_status = response.get("validationResponse", {}).get("status", "")
-        
-        # doc.custom_fbr_queue_status = "Completed"
-        doc.save(ignore_permissions=True)
-        
-        # Check if submission was successful
-        status = response.get("validationResponse", {}).get("status", "")
-        if status == "Valid":
-            return {"success": True}
-        else:
-            return {"success": False, "error": f"FBR validation failed: {status}"}
-            
     except Exception as e:
-        return {"success": False, "error": str(e)}
+        for entry in prepared:
+            results[entry["key"]] = {"success": False, "error": str(e)}
+        return results
+
+    bodies = {entry["key"]: entry["body"] for entry in prepared}
+    for name, outcome in responses:
+        item = items_by_name[name]
+        if breaker:
+            breaker.record(outcome)
+        metrics = get_request_metrics(
+            outcome, getattr(outcome, "total_seconds", None), options["api_endpoint"], item.retry_count
+        )
+
+        try:
+            if isinstance(outcome, Exception):
+                frappe.throw(f"FBR submission error: {str(outcome)}")
+            response = parse_fbr_response(outcome)
+        except Exception as e:
+            log_fbr_submission(item.document_type, item.document_name, "", {"error": str(e)}, "Error", metrics)
+            results[name] = {"success": False, "error": str(e)}
+            continue
+
+        status = response.get("validationResponse", {}).get("status")
+        log_fbr_submission(item.document_type, item.document_name, bodies[name], response, "Success" if status == "Valid" else "Invalid", metrics)
+
+        try:
+            results[name] = apply_fbr_response(item, response)
+        except Exception as e:
+            results[name] = {"success": False, "error": str(e)}
+
+    return results
+
+def apply_fbr_response(queue_item, response):
+    """Store the FBR response on the invoice and report whether it was accepted"""
+    # Only the FBR columns change, so write them in one UPDATE instead of
+    # re-running the whole save lifecycle (validate hooks etc.) of the invoice
+    response_field = "custom_fbr_response" if queue_item.document_type == "Sales Invoice" else "custom_fbr_responce"
+    values = {
+        response_field: json.dumps(response, separators=(",", ":")),
+        "custom_fbr_invoice_number": response.get("invoiceNumber", ""),
+        "custom_fbr_datetime": response.get("dated") or None,
+        "custom_fbr_status": response.get("validationResponse", {}).get("status", ""),
+    }
+    # POS Invoice has no custom_fbr_datetime; an unknown column would fail
+    # the UPDATE after PRAL already accepted the invoice
+    meta = frappe.get_meta(queue_item.document_type)
+    frappe.db.set_value(queue_item.document_type, queue_item.document_name, {
+        field: value for field, value in values.items() if meta.has_field(field)
+    })
+    
+    # Check if submission was successful
+    status = response.get("validationResponse", {}).get("status", "")
+    if status == "Valid":
+        return {"success": True}
+    else:
+        return {"success": False, "error": f"FBR validation failed: {status}"}
 
 @frappe.whitelist()
 def get_queue_status():
@@ -185,12 +633,8 @@ def get_queue_status():
 def retry_failed_items():
     """Retry all failed items in the queue"""
     try:
-        # Reset failed items to pending (max 5 total retries)
-        frappe.db.sql("""
-            UPDATE `tabFBR Queue`
-            SET status = 'Pending', error_message = ''
-            WHERE status = 'Failed' AND retry_count < 5
-        """)
+        # Reset failed items that still have retries left to pending
+        frappe.db.sql(RETRY_FAILED_ITEMS_SQL, {"now": now(), "max_retries": DEFAULT_MAX_RETRIES})
         
         frappe.db.commit()
         
@@ -203,21 +647,44 @@ def retry_failed_items():
         frappe.log_error(f"Error retrying failed items: {str(e)}", "FBR Queue")
         return {"retry_count": 0, "error": str(e)}
 
-def cleanup_old_queue_items():
-    """Clean up old completed queue items"""
-    try:
-        # Delete completed items older than 30 days
-        cutoff_date = add_to_date(None, days=-30)
-        
-        frappe.db.sql("""
-            DELETE FROM `tabFBR Queue`
-            WHERE status = 'Completed' AND completed_at < %s
-        """, cutoff_date)
-        
-        frappe.db.commit()
-        
-    except Exception as e:
-        frappe.log_error(f"Error cleaning up queue: {str(e)}", "FBR Queue Cleanup")
+def archive_completed_queue_items(chunk_size=QUEUE_ARCHIVE_CHUNK_SIZE):
+    """Move Completed rows into FBR Queue Archive, one bounded chunk per transaction.
+
+    Runs daily. Each chunk is copied and deleted by name and committed on
+    its own, so row locks on the live queue are held for one chunk only and
+    concurrent submissions are never stalled behind a large DELETE.
+    Returns the number of rows archived.
+    """
+    cutoff = add_to_date(now_datetime(), days=-QUEUE_ARCHIVE_AFTER_DAYS)
+    columns = ", ".join(f"`{column}`" for column in QUEUE_ARCHIVE_COLUMNS)
+    archived = 0
+
+    while True:
+        names = frappe.db.sql_list(ARCHIVE_CHUNK_SQL, {"cutoff": cutoff, "limit": chunk_size})
+        if not names:
+            break
+
+        try:
+            frappe.db.sql(f"""
+                INSERT INTO `tabFBR Queue Archive` ({columns}, `archived_at`)
+                SELECT {columns}, %s FROM `tabFBR Queue`
+                WHERE name IN %s AND status = 'Completed'
+            """, (now(), names))
+            frappe.db.sql("""
+                DELETE FROM `tabFBR Queue`
+                WHERE name IN %s AND status = 'Completed'
+            """, (names,))
+            frappe.db.commit()
+        except Exception as e:
+            frappe.db.rollback()
+            frappe.log_error(f"Error archiving queue items: {str(e)}", "FBR Queue Archive")
+            break
+
+        archived += len(names)
+        if len(names) < chunk_size:
+            break
+
+    return archived
 
 # Scheduled task to process queue automatically
 def process_fbr_queue_scheduled():
@@ -227,8 +694,18 @@ def process_fbr_queue_scheduled():
         pending_count = frappe.db.count("FBR Queue", {"status": "Pending"})
         
         if pending_count > 0:
-            result = process_queue(limit=20)  # Process 20 items at a time
-            frappe.log_error(f"Scheduled FBR queue processing: {result}", "FBR Queue Scheduled")
+            # Fan out to parallel workers; row claiming keeps them from overlapping
+            workers = cint(frappe.db.get_single_value("FBR E-Inv Setup", "queue_workers")) or 1
+            time_budget = get_queue_time_budget()
+            for idx in range(workers):
+                frappe.enqueue(
+                    "fbr_e_invoicing.api.fbr_queue.drain_queue",
+                    queue="long",
+                    timeout=time_budget + QUEUE_LEASE_SECONDS,
+                    job_id=f"fbr_queue_worker_{idx}",
+                    deduplicate=True,
+                    time_budget=time_budget
+                )
             
     except Exception as e:
-        frappe.log_error(f"Error in scheduled FBR queue processing: {str(e)}", "FBR Queue Scheduled")
\ No newline at end of file
+        frappe.log_error(f"Error in scheduled FBR queue processing: {str(e)}", "FBR Queue Scheduled")
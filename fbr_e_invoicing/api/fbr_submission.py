@@ -1,41 +1,111 @@
 import frappe
 import json
 import requests
+import time
 from datetime import datetime
-from frappe.utils import now, flt
+from frappe.utils import now, flt, cint, getdate
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from fbr_e_invoicing.api.rate_limiter import get_rate_limiter
+from fbr_e_invoicing.api.circuit_breaker import FBRCircuitOpen, get_circuit_breaker
+from fbr_e_invoicing.api.payload_core import canonical_json, payload_hash
+from fbr_e_invoicing.api.log_buffer import buffer_log
+from fbr_e_invoicing.api.submission_metrics import get_request_metrics
+
+# Per-site pooled sessions for this worker: site -> (settings key, session)
+_sessions = {}
+
+# Dashboards may see FBR Queue counts this many seconds old
+QUEUE_STATS_CACHE_SECONDS = 30
 
 @frappe.whitelist()
-def submit_single_invoice(doctype, docname, is_retry=False):
+def submit_single_invoice(doctype, docname, is_retry=False, retry_attempt=0):
     """Submit a single invoice to FBR"""
+    metrics = {"retry_attempt": cint(retry_attempt)}
     try:
-        # Get the document
-        doc = frappe.get_doc(doctype, docname)
-        
-        # Build the payload
-        if doctype == "Sales Invoice":
-            from fbr_e_invoicing.api.build_fbr_payload import build_fbr_payload
-            payload = build_fbr_payload(docname)
-        elif doctype == "POS Invoice":  # POS Invoice
-            # Get payload from the document
-            if not doc.custom_payload:
-                frappe.throw("No FBR payload found. Please regenerate the payload.")
-            payload = json.loads(doc.custom_payload)
-        else:
-            frappe.throw("Unknown Doctype error in submit_single_invoice function")
-            return 500
+        # The stored payload string, sent as is
+        body = get_invoice_body(doctype, docname)
+
         # Submit to FBR
-        response = submit_to_fbr_api(payload, doc.name, doctype, is_retry)
+        response = submit_to_fbr_api(body, docname, doctype, is_retry, metrics=metrics)
         
         # Log the submission
-        log_fbr_submission(doctype, docname, payload, response, "Success" if response.get("validationResponse", {}).get("status") == "Valid" else "Invalid")
+        log_fbr_submission(doctype, docname, body, response, "Success" if response.get("validationResponse", {}).get("status") == "Valid" else "Invalid", metrics)
         
         return response
         
     except Exception as e:
         # Log the error
-        log_fbr_submission(doctype, docname, {}, {"error": str(e)}, "Error")
+        log_fbr_submission(doctype, docname, "", {"error": str(e)}, "Error", metrics)
         frappe.throw(f"FBR submission failed: {str(e)}")
 
+def get_invoice_body(doctype, docname):
+    """Return the stored FBR payload string of an invoice, the exact request body"""
+    if doctype not in ("Sales Invoice", "POS Invoice"):
+        frappe.throw("Unknown Doctype error in submit_single_invoice function")
+
+    bodies = get_invoice_bodies(doctype, [docname])
+    if docname not in bodies:
+        frappe.throw(f"{doctype} {docname} not found or not submitted")
+    return bodies[docname]
+
+def get_invoice_bodies(doctype, docnames):
+    """Batch variant of get_invoice_body: returns {docname: body}.
+
+    Payloads are frozen at submit (Sales Invoice) or save (POS Invoice);
+    invoices stored without one get it built and stored once here. A Sales
+    Invoice whose stored payload no longer matches its hash raises instead
+    of being sent. Names that do not exist are left out; the caller reports
+    them, as are invoices that are not submitted (draft or cancelled).
+    """
+    if doctype not in ("Sales Invoice", "POS Invoice"):
+        frappe.throw("Unknown Doctype error in submit_single_invoice function")
+
+    fields = ["name", "custom_payload"]
+    if doctype == "Sales Invoice":
+        fields.append("custom_payload_hash")
+
+    rows = frappe.get_all(doctype, filters={"name": ["in", list(docnames)], "docstatus": 1}, fields=fields)
+    bodies = {}
+    for row in rows:
+        if row.custom_payload and row.get("custom_payload_hash") \
+                and payload_hash(row.custom_payload) != row.custom_payload_hash:
+            frappe.throw(f"Stored FBR payload of {doctype} {row.name} does not match its hash")
+        if row.custom_payload:
+            bodies[row.name] = row.custom_payload
+
+    missing = [row.name for row in rows if not row.custom_payload]
+    if missing and doctype == "Sales Invoice":
+        bodies.update(build_missing_sales_invoice_payloads(missing))
+    elif missing:
+        bodies.update(build_missing_pos_payloads(missing))
+    return bodies
+
+def build_missing_sales_invoice_payloads(docnames):
+    """Build and freeze payloads of Sales Invoices submitted without one; returns {docname: body}"""
+    from fbr_e_invoicing.api.build_fbr_payload import build_fbr_payloads, store_fbr_payload
+
+    return {
+        docname: store_fbr_payload(docname, payload)
+        for docname, payload in build_fbr_payloads(docnames).items()
+    }
+
+def build_missing_pos_payloads(docnames):
+    """Build and store payloads of POS Invoices saved without one; returns {docname: body}.
+
+    With POS Payload Mode "On Submission" the payload is left out of checkout
+    and built here, in the queue worker, right before it is sent. It is
+    stored so retries resend the same payload.
+    """
+    from fbr_e_invoicing.api.pos_invoice_build_payload import build_pos_payload
+
+    bodies = {}
+    for docname in docnames:
+        body = canonical_json(build_pos_payload(frappe.get_doc("POS Invoice", docname)))
+        frappe.db.set_value("POS Invoice", docname, "custom_payload", body, update_modified=False)
+        bodies[docname] = body
+    return bodies
+
 @frappe.whitelist()
 def bulk_submit_invoices(doctype, docnames):
     """Submit multiple invoices to FBR queue"""
@@ -59,7 +129,8 @@ def bulk_submit_invoices(doctype, docnames):
                 "document_name": docname,
                 "status": "Pending",
                 "priority": 5,  # Normal priority
-                "created_at": now()
+                "created_at": now(),
+                "next_retry_at": now()
             })
             queue_doc.insert(ignore_permissions=True)
             
@@ -77,16 +148,54 @@ def bulk_submit_invoices(doctype, docnames):
     
     return {"queued_count": queued_count}
 
-def submit_to_fbr_api(payload, document_name, document_type, is_retry=False):
-    """Submit payload to FBR API via HTTP POST and return parsed JSON dict.
+def get_fbr_session(fbr_settings):
+    """Return this worker's keep-alive session for the FBR endpoint.
 
-    Raises frappe.ValidationError (frappe.throw) with a readable message on failures.
+    The session is rebuilt whenever the endpoint, token or connection tuning
+    in FBR E-Inv Setup changes.
     """
-    import requests
-    from requests.exceptions import RequestException, Timeout, HTTPError
-    import json as _json
+    api_endpoint = (fbr_settings.api_endpoint or "").strip()
+    token = (fbr_settings.pral_authorization_token or "").strip()
+    pool_size = cint(getattr(fbr_settings, "http_pool_size", 0)) or 10
+    max_retries = cint(getattr(fbr_settings, "http_max_retries", 0))
+    backoff_factor = flt(getattr(fbr_settings, "http_backoff_factor", 0.5))
 
-    fbr_settings = frappe.get_single("FBR E-Inv Setup")
+    key = (api_endpoint, token, pool_size, max_retries, backoff_factor)
+    cached = _sessions.get(frappe.local.site)
+    if cached and cached[0] == key:
+        return cached[1]
+    if cached:
+        cached[1].close()
+
+    # Only retry when the request never reached PRAL or was explicitly
+    # rejected before processing, so an invoice is never posted twice.
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=max_retries,
+        status_forcelist=(429, 503),
+        allowed_methods=frozenset({"POST"}),
+        backoff_factor=backoff_factor,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+        "X-Client": "ERPNext FBR E-Invoicing",
+    })
+
+    _sessions[frappe.local.site] = (key, session)
+    return session
+
+def get_fbr_request_options(fbr_settings):
+    """Endpoint, timeout and TLS verification for FBR API calls"""
     api_endpoint = (fbr_settings.api_endpoint or "").strip()
     token = (fbr_settings.pral_authorization_token or "").strip()
 
@@ -94,102 +203,170 @@ def submit_to_fbr_api(payload, document_name, document_type, is_retry=False):
         frappe.throw("FBR API settings not configured. Please set API Endpoint and Authorization Token in 'FBR E-Inv Setup'.")
 
     verify_ssl = getattr(fbr_settings, "verify_ssl", True)
-    connect_timeout = float(getattr(fbr_settings, "connect_timeout", 10.0))
-    read_timeout = float(getattr(fbr_settings, "read_timeout", 30.0))
-    timeout = (connect_timeout, read_timeout)
+    connect_timeout = flt(getattr(fbr_settings, "connect_timeout", 0)) or 10.0
+    read_timeout = flt(getattr(fbr_settings, "read_timeout", 0)) or 30.0
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
+    return {
+        "api_endpoint": api_endpoint,
+        "timeout": (connect_timeout, read_timeout),
+        "verify": bool(verify_ssl),
+    }
+
+def get_fbr_request_headers(document_name, document_type, is_retry=False):
+    """Per-request headers; Authorization, Content-Type and X-Client live on the pooled session"""
+    return {
         "X-Document-Name": str(document_name),
         "X-Document-Type": str(document_type),
-        "X-Client": "ERPNext FBR E-Invoicing",
         "X-Retry": "1" if is_retry else "0",
     }
 
+def parse_fbr_response(resp):
+    """Return the JSON body of an FBR response as a dict.
+
+    Raises frappe.ValidationError (frappe.throw) with a readable message for HTTP errors.
+    """
+    from requests.exceptions import HTTPError
+
+    text = resp.text or ""
     try:
-        resp = requests.post(
-            api_endpoint,
-            json=payload,
-            headers=headers,
-            timeout=timeout,
-            verify=bool(verify_ssl),
-        )
+        data = resp.json() if text else {}
+    except ValueError:
+        data = {"raw": text}  
 
-        text = resp.text or ""
-        try:
-            data = resp.json() if text else {}
-        except ValueError:
-            data = {"raw": text}  
+    try:
+        resp.raise_for_status()
+    except HTTPError as http_err:
+        err_msg = None
+        if isinstance(data, dict):
+            err_msg = (
+                data.get("message")
+                or data.get("error")
+                or data.get("validationResponse", {}).get("error")
+                or data.get("validationResponse", {}).get("status")
+            )
+        status_line = f"HTTP {resp.status_code}"
+        details = f" | Details: {err_msg}" if err_msg else (f" | Body: {text[:500]}" if text else "")
+        frappe.throw(f"FBR API error {status_line}{details}")
+
+    if not isinstance(data, dict):
+        data = {"result": "success", "raw": text}
+
+    return data
+
+def submit_to_fbr_api(body, document_name, document_type, is_retry=False, metrics=None):
+    """POST a stored payload string to the FBR API as is and return the parsed JSON dict.
+
+    If a `metrics` dict is passed, the request's timing and status fields for
+    FBR Logs are added to it (see submission_metrics.get_request_metrics).
+    Raises frappe.ValidationError (frappe.throw) with a readable message on failures.
+    """
+    fbr_settings = frappe.get_single("FBR E-Inv Setup")
+    options = get_fbr_request_options(fbr_settings)
 
+    # Fail fast instead of waiting out the timeouts while PRAL is down
+    breaker = get_circuit_breaker(fbr_settings)
+    if breaker and breaker.allow_request() == "open":
+        frappe.throw("FBR endpoint is currently unavailable (circuit open). Please try again shortly.", FBRCircuitOpen)
+
+    try:
+        session = get_fbr_session(fbr_settings)
+
+        # Stay inside PRAL's quota across all workers
+        limiter = get_rate_limiter(fbr_settings)
+        if limiter:
+            limiter.acquire()
+
+        start = time.perf_counter()
         try:
-            resp.raise_for_status()
-        except HTTPError as http_err:
-            err_msg = None
-            if isinstance(data, dict):
-                err_msg = (
-                    data.get("message")
-                    or data.get("error")
-                    or data.get("validationResponse", {}).get("error")
-                    or data.get("validationResponse", {}).get("status")
-                )
-            status_line = f"HTTP {resp.status_code}"
-            details = f" | Details: {err_msg}" if err_msg else (f" | Body: {text[:500]}" if text else "")
-            frappe.throw(f"FBR API error {status_line}{details}")
-
-        if not isinstance(data, dict):
-            data = {"result": "success", "raw": text}
-
-        return data
+            resp = session.post(
+                options["api_endpoint"],
+                data=body,
+                headers=get_fbr_request_headers(document_name, document_type, is_retry),
+                timeout=options["timeout"],
+                verify=options["verify"],
+            )
+        except Exception as e:
+            if metrics is not None:
+                metrics.update(get_request_metrics(e, time.perf_counter() - start, options["api_endpoint"], metrics.get("retry_attempt")))
+            if breaker:
+                breaker.record(e)
+            raise
+
+        if metrics is not None:
+            metrics.update(get_request_metrics(resp, time.perf_counter() - start, options["api_endpoint"], metrics.get("retry_attempt")))
+        if breaker:
+            breaker.record(resp)
+        return parse_fbr_response(resp)
     
     except Exception as e:
         frappe.throw(f"FBR submission error: {str(e)}")
 
-def log_fbr_submission(document_type, document_name, payload, response, status):
-    """Log FBR submission to FBR Logs"""
+def log_fbr_submission(document_type, document_name, body, response, status, metrics=None):
+    """Log FBR submission to FBR Logs.
+
+    `body` is the payload string that was sent ("" if nothing was sent) and
+    `metrics` holds the request's timing/status fields, if it was sent.
+    The row is buffered and bulk inserted by a background flush, so logging
+    adds no INSERT or commit to the submission path.
+    """
     try:
-        log_doc = frappe.new_doc("FBR Logs")
-        log_doc.update({
+        buffer_log({
+            **(metrics or {}),
             "document_type": document_type,
             "document_name": document_name,
-            "request_payload": json.dumps(payload, indent=2) if payload else "",
-            "response_data": json.dumps(response, indent=2) if response else "",
+            "request_payload": body or "",
+            "response_data": json.dumps(response, separators=(",", ":")) if response else "",
             "status": status,
             "submitted_at": now(),
             "fbr_invoice_number": response.get("invoiceNumber", "") if response else ""
         })
-        log_doc.insert(ignore_permissions=True)
-        frappe.db.commit()
     except Exception as e:
         frappe.log_error(f"Error logging FBR submission: {str(e)}", "FBR Logging")
 
 @frappe.whitelist()
-def get_fbr_submission_stats():
-    """Get FBR submission statistics"""
+def get_fbr_submission_stats(from_date=None, to_date=None):
+    """Get FBR submission statistics (today unless a date range is given)"""
     try:
-        stats = frappe.db.sql("""
-            SELECT 
-                status,
-                COUNT(*) as count
-            FROM `tabFBR Logs`
-            WHERE DATE(submitted_at) = CURDATE()
-            GROUP BY status
-        """, as_dict=True)
+        from_date = getdate(from_date) if from_date else getdate()
+        to_date = getdate(to_date) if to_date else from_date
+
+        # One row per day, document type and status, kept up to date by the log writer
+        rollup = frappe.get_all(
+            "FBR Submission Rollup",
+            filters={"day": ["between", [from_date, to_date]]},
+            fields=[
+                "day", "document_type", "status", "submission_count",
+                "timed_count", "total_processing_time", "ttfb_count", "total_time_to_first_byte"
+            ],
+            order_by="day asc"
+        )
+
+        counts = {}
+        for row in rollup:
+            counts[row.status] = counts.get(row.status, 0) + row.submission_count
+            row.avg_processing_time = round(row.total_processing_time / row.timed_count, 2) if row.timed_count else None
+            row.avg_time_to_first_byte = round(row.total_time_to_first_byte / row.ttfb_count, 2) if row.ttfb_count else None
+
+        return {
+            "today_submissions": [{"status": status, "count": count} for status, count in counts.items()],
+            "submissions": rollup,
+            "queue_status": get_queue_status_counts()
+        }
         
-        # Get queue statistics
-        queue_stats = frappe.db.sql("""
+    except Exception as e:
+        frappe.log_error(f"Error getting FBR stats: {str(e)}", "FBR Stats")
+        return {"today_submissions": [], "submissions": [], "queue_status": []}
+
+def get_queue_status_counts():
+    """FBR Queue row counts per status, cached for QUEUE_STATS_CACHE_SECONDS"""
+    counts = frappe.cache().get_value("fbr_queue_status_counts")
+    if counts is None:
+        counts = frappe.db.sql("""
             SELECT 
                 status,
                 COUNT(*) as count
             FROM `tabFBR Queue`
             GROUP BY status
         """, as_dict=True)
-        
-        return {
-            "today_submissions": stats,
-            "queue_status": queue_stats
-        }
-        
-    except Exception as e:
-        frappe.log_error(f"Error getting FBR stats: {str(e)}", "FBR Stats")
-        return {"today_submissions": [], "queue_status": []}
\ No newline at end of file
+        frappe.cache().set_value("fbr_queue_status_counts", counts, expires_in_sec=QUEUE_STATS_CACHE_SECONDS)
+    return counts
\ No newline at end of file
@@ -2,6 +2,8 @@ import frappe
 from frappe import _
 from datetime import datetime
 from frappe.utils import nowdate, now_datetime
+from fbr_e_invoicing.api.pos_invoice_build_payload import get_pos_payload_mode
+from fbr_e_invoicing.api.fbr_cache import get_party_fields, get_scenario_ids
 
 def validate_fbr_fields(doc, method):
     """Validate FBR required fields before saving Sales Invoice"""
@@ -12,7 +14,7 @@ def validate_fbr_fields(doc, method):
     errors = []
     
     # Check if FBR setup is configured
-    fbr_settings = frappe.get_single("FBR E-Inv Setup")
+    fbr_settings = frappe.get_cached_doc("FBR E-Inv Setup")
     if not fbr_settings.api_endpoint:
         errors.append(_("FBR API endpoint not configured in FBR E-Inv Setup"))
     
@@ -35,7 +37,7 @@ def validate_fbr_fields(doc, method):
     
     # Validate customer tax information
     if doc.customer:
-        customer = frappe.get_doc("Customer", doc.customer)
+        customer = get_party_fields("Customer", doc.customer)
         if not customer.tax_id and not customer.custom_province:
             frappe.msgprint(
                 _("Customer {0} is missing Tax ID or Province information required for FBR").format(customer.customer_name),
@@ -45,7 +47,7 @@ def validate_fbr_fields(doc, method):
     
     # Validate company tax information
     if doc.company:
-        company = frappe.get_doc("Company", doc.company)
+        company = get_party_fields("Company", doc.company)
         if not company.tax_id:
             errors.append(_("Company Tax ID is required for FBR submission"))
     
@@ -64,21 +66,32 @@ def validate_fbr_items(doc, errors):
     
     missing_hs_codes = []
     missing_tax_templates = []
+    unknown_sale_types = []
+    scenario_ids = get_scenario_ids()
+
+    # HS codes of all Item masters in one query
+    item_codes = list({item.item_code for item in doc.items if item.item_code})
+    master_hs_codes = dict(frappe.get_all(
+        "Item",
+        filters={"name": ["in", item_codes]},
+        fields=["name", "custom_hs_code"],
+        as_list=True
+    )) if item_codes else {}
     
     for idx, item in enumerate(doc.items, 1):
-        # Check HS Code
+        # Check HS Code; point at the Item master's code when the row lost it
         if not item.custom_hs_code:
-            missing_hs_codes.append(f"Row {idx}: {item.item_name}")
+            master_hs_code = master_hs_codes.get(item.item_code)
+            hint = f" (Item master: {master_hs_code})" if master_hs_code else ""
+            missing_hs_codes.append(f"Row {idx}: {item.item_name}{hint}")
         
         # Check Item Tax Template
         if not item.item_tax_template:
             missing_tax_templates.append(f"Row {idx}: {item.item_name}")
-        
-        # Validate item master data
-        item_master = frappe.get_doc("Item", item.item_code)
-        if not item_master.custom_hs_code and not item.custom_hs_code:
-            # Item doesn't have HS code in master or transaction
-            continue
+
+        # Check FBR Sale Type resolves to a scenario
+        if item.get("custom_sale_type") and not scenario_ids.get(item.custom_sale_type):
+            unknown_sale_types.append(f"Row {idx}: {item.custom_sale_type}")
     
     if missing_hs_codes:
         errors.append(_("Following items are missing HS Codes required for FBR:<br>{0}").format("<br>".join(missing_hs_codes)))
@@ -86,6 +99,13 @@ def validate_fbr_items(doc, errors):
     if missing_tax_templates:
         errors.append(_("Following items are missing Item Tax Templates required for FBR:<br>{0}").format("<br>".join(missing_tax_templates)))
 
+    if unknown_sale_types:
+        frappe.msgprint(
+            _("Following items have an FBR Sale Type without a Scenario ID:<br>{0}").format("<br>".join(unknown_sale_types)),
+            alert=True,
+            indicator='orange'
+        )
+
 @frappe.whitelist()
 def validate_fbr_document(doctype, docname):
     """API method to validate a document for FBR compliance"""
@@ -122,8 +142,8 @@ def validate_pos_invoice_fbr(doc, errors):
         if not pos_profile.company:
             errors.append(_("POS Profile must have a company assigned"))
     
-    # Check if payload exists
-    if not doc.custom_payload:
+    # Check if payload exists (On Submission mode builds it in the queue worker)
+    if not doc.custom_payload and get_pos_payload_mode() != "On Submission":
         errors.append(_("FBR payload not found. Document may need to be saved first."))
 
 def get_fbr_warnings(doc):
@@ -0,0 +1,180 @@
+import frappe
+import json
+from frappe.model.naming import parse_naming_series
+from frappe.utils import now
+from frappe.utils.background_jobs import get_redis_conn
+from fbr_e_invoicing.api.submission_metrics import update_submission_rollup
+
+# Lists in the queue Redis (persistent, no eviction, unlike the cache Redis):
+# rows not written to the database yet, and the batch a flush is inserting
+LOG_BUFFER_KEY = "fbr_logs_buffer"
+LOG_PROCESSING_KEY = "fbr_logs_buffer:processing"
+
+# Held by the one flush allowed to run at a time; renewed before every batch
+LOG_FLUSH_LOCK_KEY = "fbr_logs_buffer:flush_lock"
+LOG_FLUSH_LOCK_SECONDS = 300
+
+# Back-pressure: past this many waiting rows the oldest ones are dropped
+MAX_BUFFERED_LOGS = 5000
+
+# Rows per multi-row INSERT; a flush job is also started each time this many are buffered
+LOG_FLUSH_BATCH_SIZE = 500
+
+# FBR Logs naming series, split into the prefix and its number of digits
+LOG_NAMING_SERIES = "FBR-LOG-.YYYY.-.MM.-.DD.-.#####."
+LOG_NAMING_PREFIX = "FBR-LOG-.YYYY.-.MM.-.DD.-."
+LOG_NAMING_DIGITS = 5
+
+# Columns written for every buffered row besides name and the standard fields
+LOG_FIELDS = (
+    "naming_series", "document_type", "document_name", "fbr_invoice_number",
+    "status", "submitted_at", "request_payload", "response_data",
+    "processing_time", "time_to_first_byte", "response_status_code", "retry_attempt", "api_version",
+)
+
+# Move up to ARGV[1] rows from the head of the buffer to the processing list
+TAKE_BATCH_SCRIPT = """
+local rows = {}
+for i = 1, tonumber(ARGV[1]) do
+    local row = redis.call('LMOVE', KEYS[1], KEYS[2], 'LEFT', 'RIGHT')
+    if not row then
+        break
+    end
+    rows[#rows + 1] = row
+end
+return rows
+"""
+
+# Move the processing list back to the head of the buffer, keeping its order
+RETURN_BATCH_SCRIPT = """
+while redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'LEFT') do
+end
+return 1
+"""
+
+def _redis():
+    return get_redis_conn()
+
+def _buffer_key():
+    return frappe.cache().make_key(LOG_BUFFER_KEY)
+
+def _processing_key():
+    return frappe.cache().make_key(LOG_PROCESSING_KEY)
+
+def _lock_key():
+    return frappe.cache().make_key(LOG_FLUSH_LOCK_KEY)
+
+def buffer_log(row):
+    """Queue one FBR Logs row (dict of LOG_FIELDS) for a bulk insert.
+
+    Never writes to, commits or rolls back the caller's database
+    connection: callers log in the middle of their own transaction. If the
+    flush job falls behind, the buffer keeps the newest MAX_BUFFERED_LOGS
+    rows and the dropped ones are reported in the app log.
+    """
+    row.setdefault("naming_series", LOG_NAMING_SERIES)
+    row.setdefault("submitted_at", now())
+    row.setdefault("owner", frappe.session.user)
+
+    key = _buffer_key()
+    pipe = _redis().pipeline()
+    pipe.rpush(key, json.dumps(row, separators=(",", ":"), default=str))
+    pipe.ltrim(key, -MAX_BUFFERED_LOGS, -1)
+    length = pipe.execute()[0]
+
+    if length > MAX_BUFFERED_LOGS:
+        frappe.logger("fbr_e_invoicing").error(
+            f"FBR Logs buffer full: dropped the {length - MAX_BUFFERED_LOGS} oldest row(s)"
+        )
+
+    if length == 1 or length % LOG_FLUSH_BATCH_SIZE == 0 or length >= MAX_BUFFERED_LOGS:
+        frappe.enqueue(
+            "fbr_e_invoicing.api.log_buffer.flush_log_buffer",
+            queue="short",
+            job_id="fbr_logs_flush",
+            deduplicate=True
+        )
+
+def flush_log_buffer(max_batches=None):
+    """Write buffered rows to FBR Logs in multi-row INSERTs; returns rows written.
+
+    Each batch is moved to a processing list and only deleted once its
+    INSERT has committed, so a killed worker loses nothing: the next flush
+    inserts the leftover batch first. A worker killed between the commit and
+    the delete makes that batch be inserted twice.
+    """
+    redis = _redis()
+    lock_key = _lock_key()
+    if not redis.set(lock_key, frappe.local.site, nx=True, ex=LOG_FLUSH_LOCK_SECONDS):
+        return 0
+
+    written = 0
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            redis.expire(lock_key, LOG_FLUSH_LOCK_SECONDS)
+            rows = _take_batch(LOG_FLUSH_BATCH_SIZE)
+            if not rows:
+                break
+
+            try:
+                insert_log_rows(rows)
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                _return_batch()
+                frappe.log_error(title="FBR Logs flush failed")
+                break
+
+            redis.delete(_processing_key())
+            written += len(rows)
+            batches += 1
+    finally:
+        redis.delete(lock_key)
+    return written
+
+def _take_batch(size):
+    """Return the processing list, first moving up to `size` rows into it if it is empty"""
+    redis = _redis()
+    raw = redis.lrange(_processing_key(), 0, -1)
+    if not raw:
+        raw = redis.eval(TAKE_BATCH_SCRIPT, 2, _buffer_key(), _processing_key(), size)
+    return [json.loads(item) for item in raw]
+
+def _return_batch():
+    """Put the rows of a failed flush back at the head of the buffer, in order"""
+    _redis().eval(RETURN_BATCH_SCRIPT, 2, _processing_key(), _buffer_key())
+
+def insert_log_rows(rows):
+    """Insert FBR Logs rows with one naming series reservation and multi-row INSERTs"""
+    timestamp = now()
+    names = reserve_log_names(len(rows))
+    fields = ["name", "creation", "modified", "owner", "modified_by", "docstatus", *LOG_FIELDS]
+
+    values = []
+    for name, row in zip(names, rows):
+        owner = row.get("owner") or "Administrator"
+        values.append([name, timestamp, timestamp, owner, owner, 0, *[row.get(field) for field in LOG_FIELDS]])
+
+    frappe.db.bulk_insert("FBR Logs", fields, values, chunk_size=LOG_FLUSH_BATCH_SIZE)
+    update_submission_rollup(rows)
+
+def reserve_log_names(count):
+    """Reserve `count` consecutive FBR Logs names with a single tabSeries update"""
+    prefix = parse_naming_series(LOG_NAMING_PREFIX)
+    current = frappe.db.sql("SELECT `current` FROM `tabSeries` WHERE `name`=%s FOR UPDATE", (prefix,))
+    if current:
+        start = (current[0][0] or 0) + 1
+        frappe.db.sql("UPDATE `tabSeries` SET `current` = `current` + %s WHERE `name`=%s", (count, prefix))
+    else:
+        start = 1
+        frappe.db.sql("INSERT INTO `tabSeries` (`name`, `current`) VALUES (%s, %s)", (prefix, count))
+
+    return [f"{prefix}{number:0{LOG_NAMING_DIGITS}d}" for number in range(start, start + count)]
+
+@frappe.whitelist()
+def get_log_buffer_size():
+    """Rows waiting in the FBR Logs buffer, including a batch being flushed"""
+    frappe.only_for("System Manager")
+    redis = _redis()
+    return redis.llen(_buffer_key()) + redis.llen(_processing_key())
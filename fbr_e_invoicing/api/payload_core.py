@@ -0,0 +1,110 @@
+"""Pure FBR payload construction, free of frappe and the database.
+
+The frappe side loads invoices, lines and resolved party data into the
+records below; turning those into FBR JSON needs nothing else. Records use
+`__slots__` to stay small in large backfills and pickle cheaply, so
+`build_payloads` can spread the work over a process pool.
+"""
+import hashlib
+import json
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from fbr_e_invoicing.api.payload_mapping import get_payload_mapping
+
+# Below this many invoices a process pool costs more than it saves
+MIN_PARALLEL_INVOICES = 200
+
+
+class LineRecord:
+    """One invoice line with the fields the item mappings read"""
+
+    __slots__ = (
+        "custom_hs_code", "description", "item_name", "stock_uom", "uom", "qty",
+        "rate", "discount_amount", "custom_sale_type", "item_tax_template", "tax_rate",
+    )
+
+    def __init__(self, tax_rate=0.0, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+        self.tax_rate = tax_rate
+
+    def get(self, field):
+        return getattr(self, field, None)
+
+
+class InvoiceRecord:
+    """An invoice header, its lines and the party data resolved for it"""
+
+    __slots__ = ("doctype", "name", "header", "context", "lines")
+
+    def __init__(self, doctype, name, header, context, lines):
+        self.doctype = doctype
+        self.name = name
+        self.header = header
+        self.context = context
+        self.lines = lines
+
+
+def canonical_json(payload):
+    """Compact, key-sorted JSON of a payload: the exact bytes sent to FBR.
+
+    Payloads are stored in this form and the stored string is sent as is,
+    so every (re)submission posts the same bytes.
+    """
+    return json.dumps(payload, separators=(",", ":"), sort_keys=True)
+
+
+def payload_hash(body):
+    """sha256 hex digest of a stored payload string"""
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def normalise_cnic(value: str | None) -> str:
+    """
+    Normalize CNIC/NTN/Tax IDs by removing non-digits (hyphens, spaces, etc.)
+    Examples:
+      "31303-9589654-7" -> "3130395896547"
+      " 31303 9589654 7 " -> "3130395896547"
+    """
+    if not value:
+        return ""
+    return re.sub(r"\D", "", str(value)).strip()
+
+
+def get_buyer_tax_id(customer_tax_id, nic, ntn):
+    """Customer tax id, then the invoice's CNIC, then its NTN"""
+    if customer_tax_id:
+        return customer_tax_id
+    elif nic:
+        return normalise_cnic(nic)
+    return ntn
+
+
+def get_invoice_scenario_id(line_scenario_ids):
+    """An invoice's scenario: that of its first line with a known sale type"""
+    return next((scenario_id for scenario_id in line_scenario_ids if scenario_id), "")
+
+
+def build_payload(record):
+    """Return `(name, payload)` for one InvoiceRecord"""
+    lines = record.lines
+    return record.name, get_payload_mapping(record.doctype).build(
+        record.header, record.context, lines, [{"tax_rate": line.tax_rate} for line in lines]
+    )
+
+
+def build_payloads(records, processes=None, chunksize=50):
+    """Return {name: payload} for many InvoiceRecords.
+
+    With `processes` > 1 and enough records the work runs in a pool of
+    spawned processes (never forked, so a parent's database connections are
+    not shared with the children).
+    """
+    records = list(records)
+    if not processes or processes <= 1 or len(records) < MIN_PARALLEL_INVOICES:
+        return dict(map(build_payload, records))
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return dict(pool.map(build_payload, records, chunksize=chunksize))
@@ -0,0 +1,258 @@
+"""Declarative FBR payload mappings, compiled into row-projection functions.
+
+Each invoice type declares its header and item fields once as
+`(fbr key, source)` pairs. A mapping is compiled when this module is
+imported: the pairs are turned into the source of a single function that
+returns the whole dict literal, so projecting a row costs one call and no
+per-field loop.
+
+This module has no frappe imports. Rows only need a `.get(fieldname)`
+method, so Documents, child rows, `frappe._dict`s from get_all and plain
+dicts all work. Values that need the database (party tax ids, addresses,
+tax rates, ...) are resolved by the caller and passed in as the context.
+"""
+import time
+
+
+class Field:
+    """Value of `fieldname` on the row, else of the first set `fallbacks` field"""
+
+    __slots__ = ("fieldname", "kind", "fallbacks")
+
+    def __init__(self, fieldname, kind="str", fallbacks=()):
+        self.fieldname = fieldname
+        self.kind = kind
+        self.fallbacks = tuple(fallbacks)
+
+    def expression(self, namespace):
+        gets = [f"row.get({name!r})" for name in (self.fieldname,) + self.fallbacks]
+        value = gets[0] if len(gets) == 1 else "(" + " or ".join(gets) + ")"
+        return _CONVERTERS[self.kind].format(value)
+
+
+class Ctx:
+    """Value resolved by the caller and passed in the context dict"""
+
+    __slots__ = ("key", "kind")
+
+    def __init__(self, key, kind="str"):
+        self.key = key
+        self.kind = kind
+
+    def expression(self, namespace):
+        return _CONVERTERS[self.kind].format(f"ctx.get({self.key!r})")
+
+
+class Const:
+    """The same value on every row"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def expression(self, namespace):
+        return repr(self.value)
+
+
+class Computed:
+    """`func(row, ctx)`, for values derived from several fields"""
+
+    __slots__ = ("func",)
+
+    def __init__(self, func):
+        self.func = func
+
+    def expression(self, namespace):
+        name = f"_fn{len(namespace)}"
+        namespace[name] = self.func
+        return f"{name}(row, ctx)"
+
+
+def flt(value):
+    """float() that treats None, "" and junk as 0.0, like frappe.utils.flt"""
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def iso_date(value):
+    """yyyy-mm-dd of a date/datetime or of an ISO date string"""
+    if not value:
+        return ""
+    if hasattr(value, "strftime"):
+        return value.strftime("%Y-%m-%d")
+    return str(value)[:10]
+
+
+def format_rate(tax_rate):
+    value = flt(tax_rate)
+    # If the number is a whole number (e.g. 18.0), format without decimals
+    if value.is_integer():
+        return f"{int(value)}%"
+    else:
+        return f"{value}%"
+
+
+_CONVERTERS = {
+    "str": "({} or '')",
+    "float": "_flt({})",
+    "abs_float": "abs(_flt({}))",
+    "date": "_iso_date({})",
+}
+
+
+def compile_projection(spec, name="project"):
+    """Compile `(key, source)` pairs into `func(row, ctx) -> dict`"""
+    namespace = {"_flt": flt, "_iso_date": iso_date}
+    items = ",\n        ".join(f"{key!r}: {source.expression(namespace)}" for key, source in spec)
+    code = f"def {name}(row, ctx):\n    return {{\n        {items}\n    }}\n"
+    exec(compile(code, f"<fbr mapping {name}>", "exec"), namespace)
+
+    func = namespace[name]
+    func.source = code
+    return func
+
+
+class PayloadMapping:
+    """Compiled header and item projections of one invoice type"""
+
+    def __init__(self, name, header, items):
+        self.name = name
+        self.project_header = compile_projection(header, f"project_{_identifier(name)}_header")
+        self.project_item = compile_projection(items, f"project_{_identifier(name)}_item")
+
+    def build(self, header, ctx, items, item_contexts):
+        """Payload dict for a header row and its item rows (one context per item)"""
+        payload = self.project_header(header, ctx)
+        project_item = self.project_item
+        payload["items"] = [project_item(row, row_ctx) for row, row_ctx in zip(items, item_contexts)]
+        return payload
+
+
+def _identifier(name):
+    return "".join(c if c.isalnum() else "_" for c in name.lower())
+
+
+# --- Shared pieces ---
+
+def _registration_type(row, ctx):
+    return "Registered" if ctx.get("buyer_tax_id") else "Unregistered"
+
+
+def _sales_tax_applicable(row, ctx):
+    return round((flt(ctx.get("tax_rate")) * flt(row.get("rate"))) / 100.0, 2)
+
+
+def _item_fields(uom_field, rate, sale_type):
+    return (
+        ("hsCode", Field("custom_hs_code")),
+        ("productDescription", Field("description", fallbacks=("item_name",))),
+        ("rate", rate),
+        ("uoM", Field(uom_field)),
+        ("quantity", Field("qty", "float")),
+        ("totalValues", Const(0.00)),
+        ("valueSalesExcludingST", Field("rate", "float")),
+        ("fixedNotifiedValueOrRetailPrice", Const(0.00)),
+        ("salesTaxApplicable", Computed(_sales_tax_applicable)),
+        ("salesTaxWithheldAtSource", Const(0.00)),
+        ("extraTax", Const(0.00)),
+        ("furtherTax", Const(0.00)),
+        ("sroScheduleNo", Const("")),
+        ("fedPayable", Const(0.00)),
+        ("discount", Field("discount_amount", "abs_float")),
+        ("saleType", sale_type),
+        ("sroItemSerialNo", Const("")),
+    )
+
+
+# --- Sales Invoice (and its Debit Notes) ---
+# Seller is the Company, buyer the Customer.
+
+SALES_INVOICE = PayloadMapping(
+    "Sales Invoice",
+    header=(
+        ("invoiceType", Computed(lambda row, ctx: "Debit Note" if row.get("is_debit_note") else "Sale Invoice")),
+        ("invoiceDate", Field("posting_date", "date")),
+        ("sellerNTNCNIC", Ctx("seller_tax_id")),
+        ("sellerBusinessName", Field("company")),
+        ("sellerProvince", Field("custom_province")),
+        ("sellerAddress", Ctx("seller_address")),
+        ("buyerNTNCNIC", Ctx("buyer_tax_id")),
+        ("buyerBusinessName", Ctx("buyer_name")),
+        ("buyerProvince", Field("tax_category")),
+        ("buyerAddress", Ctx("buyer_address")),
+        ("buyerRegistrationType", Computed(_registration_type)),
+        ("invoiceRefNo", Const("")),
+        ("scenarioId", Ctx("scenario_id")),
+    ),
+    items=_item_fields(
+        "stock_uom",
+        rate=Computed(lambda row, ctx: format_rate(ctx.get("tax_rate"))),
+        sale_type=Field("custom_sale_type"),
+    ),
+)
+
+# --- POS Invoice ---
+# Seller is the Customer and buyer the POS Profile's Company, as PRAL was
+# first integrated for this flow.
+
+POS_INVOICE = PayloadMapping(
+    "POS Invoice",
+    header=(
+        ("invoiceType", Const("POS Invoice")),
+        ("invoiceDate", Field("posting_date", "date")),
+        ("sellerNTNCNIC", Ctx("seller_tax_id")),
+        ("sellerBusinessName", Ctx("seller_name")),
+        ("sellerProvince", Field("tax_category")),
+        ("sellerAddress", Ctx("seller_address")),
+        ("buyerNTNCNIC", Ctx("buyer_tax_id")),
+        ("buyerBusinessName", Ctx("buyer_name")),
+        ("buyerProvince", Ctx("buyer_province")),
+        ("buyerAddress", Ctx("buyer_address")),
+        ("buyerRegistrationType", Computed(_registration_type)),
+        ("invoiceRefNo", Const("")),
+    ),
+    items=_item_fields(
+        "uom",
+        rate=Computed(lambda row, ctx: f"{flt(ctx.get('tax_rate'))}%"),
+        sale_type=Const("Goods at standard rate (default)"),
+    ),
+)
+
+PAYLOAD_MAPPINGS = {mapping.name: mapping for mapping in (SALES_INVOICE, POS_INVOICE)}
+
+
+def get_payload_mapping(doctype):
+    return PAYLOAD_MAPPINGS[doctype]
+
+
+def benchmark(lines=10000, repeat=5):
+    """Per-line cost of the compiled item projections, in microseconds.
+
+    Run with `python -m fbr_e_invoicing.api.payload_mapping`.
+    """
+    row = {
+        "custom_hs_code": "0101.2100", "description": "Widget", "item_name": "Widget",
+        "stock_uom": "Nos", "uom": "Nos", "qty": 3, "rate": 1234.5,
+        "discount_amount": -10, "custom_sale_type": "Goods at standard rate (default)",
+    }
+    rows = [row] * lines
+    contexts = [{"tax_rate": 18.0}] * lines
+
+    results = {}
+    for mapping in PAYLOAD_MAPPINGS.values():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            mapping.build({}, {}, rows, contexts)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[mapping.name] = round(best * 1e6 / lines, 3)
+    return results
+
+
+if __name__ == "__main__":
+    for name, per_line in benchmark().items():
+        print(f"{name}: {per_line} us/line")
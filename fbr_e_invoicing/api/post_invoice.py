@@ -1,5 +1,6 @@
 import frappe
 from frappe.utils import flt, formatdate
+from fbr_e_invoicing.api.fbr_cache import get_item_tax_rate, get_party_address_text
 
 
 def normalise_cnic(value: str | None) -> str:
@@ -27,7 +28,7 @@ def post(sales_invoice_name: str):
     seller_tax_id = frappe.db.get_value('Company', doc.customer, 'tax_id') if doc.customer else None
     seller_name = frappe.db.get_value('Company', doc.customer, 'name') if doc.customer else None
     seller_province = doc.custom_province
-    seller_address = _get_party_address_text('Company', doc.customer)
+    seller_address = get_party_address_text('Company', doc.customer)
     invoice_type = "Debit Note" if getattr(doc, "is_debit_note", 0) else "Sale Invoice"
     # buyer_tax_id = frappe.db.get_value('Company', doc.company, 'tax_id') if doc.company else None
     if frappe.db.get_value('Customer', doc.customer, 'tax_id'):
@@ -38,12 +39,12 @@ def post(sales_invoice_name: str):
         buyer_tax_id = doc.ntn
     buyer_name = frappe.db.get_value('Customer', doc.customer, 'customer_name') if doc.customer else None
     buyer_province = doc.tax_category
-    buyer_address = _get_party_address_text('Customer', doc.company)
+    buyer_address = get_party_address_text('Customer', doc.company)
     buyer_registration_type = "Registered" if buyer_tax_id else "Unregistered"
 
     # --- Items mapping ---
     for row in (doc.items or []):
-        tax_rate = _first_item_tax_rate(row.item_tax_template)
+        tax_rate = get_item_tax_rate(row.item_tax_template)
         value_excl_st = flt(row.rate)  # as requested: use unit rate as valueSalesExcludingST
         sales_tax_applicable = round((tax_rate * value_excl_st) / 100.0, 2)
 
@@ -69,69 +70,3 @@ def post(sales_invoice_name: str):
         payload["items"].append(item_entry)
 
     return payload
-
-
-def _get_party_address_text(link_doctype: str, link_name: str) -> str:
-    """
-    Find Address via Dynamic Link child table:
-      1) Get Address names from Dynamic Link where link_doctype/link_name match
-      2) From those Address docs, prefer primary (is_primary_address), else latest
-      3) Return "address_line1, address_line2, city, state, pincode"
-    """
-    if not (link_doctype and link_name):
-        return ""
-
-    # 1) Get parent Address names from Dynamic Link
-    address_names = frappe.get_all(
-        "Dynamic Link",
-        filters={
-            "parenttype": "Address",
-            "link_doctype": link_doctype,
-            "link_name": link_name,
-        },
-        pluck="parent",   # returns list of Address names
-        limit=50
-    )
-
-    if not address_names:
-        return ""
-
-    # 2) Pull those Address docs; prefer primary, else newest, and skip disabled
-    addresses = frappe.get_all(
-        "Address",
-        filters={
-            "name": ["in", address_names],
-            "disabled": 0,
-        },
-        fields=[
-            "name", "address_line1", "address_line2",
-            "city", "state", "pincode", "is_primary_address", "creation"
-        ],
-        order_by="is_primary_address desc, creation desc",
-        limit=1
-    )
-
-    if not addresses:
-        return ""
-
-    a = addresses[0]
-
-    # 3) Compose a readable single-line address
-    parts = [a.get("address_line1"), a.get("address_line2"), a.get("city"), a.get("state"), a.get("pincode")]
-    return ", ".join([p for p in parts if p])
-
-
-def _first_item_tax_rate(item_tax_template_name: str) -> float:
-    """
-    From Item Tax Template, get first taxes row's tax_rate.
-    Returns 0.0 if not found.
-    """
-    if not item_tax_template_name:
-        return 0.0
-    try:
-        itt = frappe.get_doc("Item Tax Template", item_tax_template_name)
-        if getattr(itt, "taxes", None) and len(itt.taxes) > 0:
-            return flt(itt.taxes[0].tax_rate)
-    except Exception:
-        pass
-    return 0.0
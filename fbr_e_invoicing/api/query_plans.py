@@ -0,0 +1,81 @@
+import frappe
+from frappe.utils import add_to_date, now
+from fbr_e_invoicing.api.fbr_queue import (
+    ARCHIVE_CHUNK_SQL,
+    CLAIM_QUEUE_ITEMS_SQL,
+    DEFAULT_MAX_RETRIES,
+    QUEUE_ARCHIVE_CHUNK_SIZE,
+    RENEW_LEASE_SQL,
+    REQUEUE_EXPIRED_LEASES_SQL,
+    RETRY_FAILED_ITEMS_SQL,
+)
+
+# The predicate-driven statements of fbr_queue.py, fbr_submission.py and
+# submission_metrics.py, as (label, sql, values). fbr_queue's raw SQL is
+# used as is from its constants; the others stand for get_all/exists calls
+# and mirror their filters. Locking clauses are left off since EXPLAIN does not
+# take them; statements keyed on `name IN` use the primary key and are not
+# listed. The per-status GROUP BY count reads every row by design (its
+# result is cached) and is not listed either.
+def get_hot_queries():
+    timestamp = now()
+    return [
+        ("queue duplicate check", """
+            SELECT name FROM `tabFBR Queue`
+            WHERE document_type = %s AND document_name = %s AND status IN ('Pending', 'Processing')
+        """, ("Sales Invoice", "ACC-SINV-00001")),
+        ("queue claim", CLAIM_QUEUE_ITEMS_SQL.format(name_condition=""), {
+            "now": timestamp, "max_retries": DEFAULT_MAX_RETRIES, "limit": 20,
+        }),
+        ("queue lease renewal", RENEW_LEASE_SQL, {"lease_expires_at": timestamp, "worker_id": "worker"}),
+        ("queue lease reaper", REQUEUE_EXPIRED_LEASES_SQL, {"max_retries": DEFAULT_MAX_RETRIES, "now": timestamp}),
+        ("queue failed items", """
+            SELECT document_type, document_name FROM `tabFBR Queue`
+            WHERE status = 'Failed' LIMIT 10
+        """, ()),
+        ("queue retry failed", RETRY_FAILED_ITEMS_SQL, {"now": timestamp, "max_retries": DEFAULT_MAX_RETRIES}),
+        ("queue pending count", """
+            SELECT COUNT(*) FROM `tabFBR Queue` WHERE status = 'Pending'
+        """, ()),
+        ("queue archive chunk", ARCHIVE_CHUNK_SQL, {"cutoff": timestamp, "limit": QUEUE_ARCHIVE_CHUNK_SIZE}),
+        ("logs latency rollup", """
+            SELECT submitted_at, document_type, processing_time FROM `tabFBR Logs`
+            WHERE submitted_at BETWEEN %s AND %s AND processing_time IS NOT NULL
+            ORDER BY submitted_at asc
+        """, (add_to_date(timestamp, hours=-24), timestamp)),
+        ("logs of one invoice", """
+            SELECT name FROM `tabFBR Logs`
+            WHERE document_type = %s AND document_name = %s
+        """, ("Sales Invoice", "ACC-SINV-00001")),
+        ("stats rollup range", """
+            SELECT day, status, submission_count FROM `tabFBR Submission Rollup`
+            WHERE day BETWEEN %s AND %s ORDER BY day asc
+        """, (add_to_date(timestamp, days=-30, as_string=True)[:10], timestamp[:10])),
+    ]
+
+def get_full_scans():
+    """EXPLAIN every hot query; return those that can only scan the whole table.
+
+    A plan is a full scan when the table is read with access type ALL and no
+    index is even a candidate. An ALL plan that does list possible keys is
+    accepted: on small tables the optimizer may rightly prefer a scan.
+    """
+    full_scans = []
+    for label, query, values in get_hot_queries():
+        for row in frappe.db.sql(f"EXPLAIN {query}", values, as_dict=True):
+            if row.get("type") == "ALL" and not row.get("possible_keys"):
+                full_scans.append({"query": label, "table": row.get("table")})
+    return full_scans
+
+def check_query_plans():
+    """Raise if a hot query falls back to a full table scan.
+
+    Run with `bench --site <site> execute fbr_e_invoicing.api.query_plans.check_query_plans`.
+    """
+    full_scans = get_full_scans()
+    if full_scans:
+        frappe.throw(
+            "<br>".join(f"{scan['query']}: full scan of {scan['table']}" for scan in full_scans),
+            title="FBR queries without a usable index"
+        )
+    return "All FBR hot queries use an index"
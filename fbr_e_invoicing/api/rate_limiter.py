@@ -0,0 +1,98 @@
+import frappe
+import hashlib
+import time
+from frappe.utils import flt, cint
+
+# Reserve one token from a bucket shared by every worker on every site that
+# uses the same PRAL token. Time comes from Redis so worker clocks don't
+# matter. Returns the seconds the caller must wait before sending; when that
+# exceeds ARGV[3] nothing is reserved and the wait is returned negated.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - 1
+
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / rate
+end
+
+if wait > max_wait then
+    redis.call('HINCRBY', KEYS[2], 'rejected', 1)
+    return tostring(-wait)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+redis.call('HINCRBY', KEYS[2], 'acquired', 1)
+if wait > 0 then
+    redis.call('HINCRBY', KEYS[2], 'throttled', 1)
+    redis.call('HINCRBYFLOAT', KEYS[2], 'wait_seconds', tostring(wait))
+end
+return tostring(wait)
+"""
+
+class FBRRateLimitExceeded(frappe.ValidationError):
+    pass
+
+class TokenBucket:
+    """Redis-backed token bucket shared across workers and sites.
+
+    Holds its own Redis client so acquire() is safe to call from the
+    submission threads, which have no site context.
+    """
+
+    def __init__(self, redis_client, bucket_id, rate, burst, max_wait=30.0):
+        self.redis = redis_client
+        self.key = f"fbr:rate_limit:{bucket_id}"
+        self.metrics_key = f"fbr:rate_limit_metrics:{bucket_id}"
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+
+    def acquire(self):
+        """Block until a request may be sent; return the seconds waited"""
+        wait = float(self.redis.eval(
+            TOKEN_BUCKET_SCRIPT, 2, self.key, self.metrics_key, self.rate, self.burst, self.max_wait
+        ))
+        if wait < 0:
+            raise FBRRateLimitExceeded(f"FBR rate limit exceeded: next slot in {-wait:.1f}s")
+        if wait:
+            time.sleep(wait)
+        return wait
+
+def _bucket_id(token):
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+def get_rate_limiter(fbr_settings):
+    """Token bucket for the configured PRAL token, or None when rate limiting is off"""
+    rate = flt(getattr(fbr_settings, "rate_limit_per_second", 0))
+    token = (fbr_settings.pral_authorization_token or "").strip()
+    if rate <= 0 or not token:
+        return None
+
+    burst = cint(getattr(fbr_settings, "rate_limit_burst", 0)) or 1
+    max_wait = flt(getattr(fbr_settings, "read_timeout", 0)) or 30.0
+    return TokenBucket(frappe.cache(), _bucket_id(token), rate, burst, max_wait)
+
+@frappe.whitelist()
+def get_rate_limit_stats():
+    """Acquire/throttle counters and total wait time for the configured PRAL token"""
+    frappe.only_for("System Manager")
+    token = (frappe.db.get_single_value("FBR E-Inv Setup", "pral_authorization_token") or "").strip()
+    if not token:
+        return {}
+
+    # Raw command: RedisWrapper.hgetall would site-prefix the key and unpickle values
+    stats = frappe.cache().execute_command("HGETALL", f"fbr:rate_limit_metrics:{_bucket_id(token)}") or {}
+    stats = {frappe.safe_decode(k): flt(frappe.safe_decode(v)) for k, v in stats.items()}
+    acquired = stats.get("acquired", 0)
+    stats["avg_wait_ms"] = round(stats.get("wait_seconds", 0) * 1000 / acquired, 2) if acquired else 0
+    return stats
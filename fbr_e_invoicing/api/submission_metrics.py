@@ -0,0 +1,124 @@
+import frappe
+import re
+from frappe.utils import add_to_date, flt, get_datetime, getdate, now, now_datetime
+
+# Version segment of the PRAL endpoint path, e.g. /di_data/v1/di/postinvoicedata
+API_VERSION_PATTERN = re.compile(r"/(v\d+(?:\.\d+)*)/")
+
+def get_api_version(api_endpoint):
+    match = API_VERSION_PATTERN.search(api_endpoint or "")
+    return match.group(1) if match else ""
+
+def get_request_metrics(outcome, total_seconds, api_endpoint, retry_attempt=0):
+    """FBR Logs timing/status fields for one request.
+
+    `outcome` is the requests.Response (or the exception raised while
+    sending). processing_time is the wall time of the POST; time_to_first_byte
+    is requests' `elapsed`, which ends when the response headers are parsed.
+    With pooled keep-alive connections the DNS/connect/TLS phases are not
+    exposed separately; they only show up in time_to_first_byte when a new
+    connection had to be opened.
+    """
+    metrics = {
+        "processing_time": round(flt(total_seconds) * 1000, 2) if total_seconds is not None else None,
+        "api_version": get_api_version(api_endpoint),
+        "retry_attempt": retry_attempt or 0,
+    }
+    if not isinstance(outcome, Exception) and outcome is not None:
+        metrics["response_status_code"] = str(outcome.status_code)
+        if outcome.elapsed is not None:
+            metrics["time_to_first_byte"] = round(outcome.elapsed.total_seconds() * 1000, 2)
+    return metrics
+
+def update_submission_rollup(rows):
+    """Add FBR Logs rows to the daily FBR Submission Rollup in one upsert.
+
+    Runs in the transaction that inserts the rows, so the rollup never
+    drifts from the log table.
+    """
+    totals = {}
+    for row in rows:
+        key = (str(getdate(row["submitted_at"])), row["document_type"], row["status"])
+        total = totals.setdefault(key, [0, 0, 0.0, 0, 0.0])
+        total[0] += 1
+        if row.get("processing_time") is not None:
+            total[1] += 1
+            total[2] += flt(row["processing_time"])
+        if row.get("time_to_first_byte") is not None:
+            total[3] += 1
+            total[4] += flt(row["time_to_first_byte"])
+
+    if not totals:
+        return
+
+    timestamp = now()
+    user = frappe.session.user
+    values = []
+    for (day, document_type, status), total in totals.items():
+        values.extend([f"{day}-{document_type}-{status}", timestamp, timestamp, user, user, day, document_type, status, *total])
+
+    frappe.db.sql(f"""
+        INSERT INTO `tabFBR Submission Rollup`
+            (name, creation, modified, owner, modified_by, day, document_type, status,
+             submission_count, timed_count, total_processing_time, ttfb_count, total_time_to_first_byte)
+        VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(totals))}
+        ON DUPLICATE KEY UPDATE
+            submission_count = submission_count + VALUES(submission_count),
+            timed_count = timed_count + VALUES(timed_count),
+            total_processing_time = total_processing_time + VALUES(total_processing_time),
+            ttfb_count = ttfb_count + VALUES(ttfb_count),
+            total_time_to_first_byte = total_time_to_first_byte + VALUES(total_time_to_first_byte),
+            modified = VALUES(modified)
+    """, values)
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+@frappe.whitelist()
+def get_latency_rollup(from_datetime=None, to_datetime=None, document_type=None):
+    """p50/p95/p99 of processing time and time to first byte per hour and document type.
+
+    Defaults to the last 24 hours. Only the submitted_at range is filtered
+    in SQL so the index on it is used; percentiles are computed here.
+    """
+    frappe.only_for("System Manager")
+    to_datetime = get_datetime(to_datetime) if to_datetime else now_datetime()
+    from_datetime = get_datetime(from_datetime) if from_datetime else add_to_date(to_datetime, hours=-24)
+
+    filters = {"submitted_at": ["between", [from_datetime, to_datetime]], "processing_time": ["is", "set"]}
+    if document_type:
+        filters["document_type"] = document_type
+
+    groups = {}
+    for row in frappe.get_all(
+        "FBR Logs",
+        filters=filters,
+        fields=["submitted_at", "document_type", "processing_time", "time_to_first_byte"],
+        order_by="submitted_at asc"
+    ):
+        hour = get_datetime(row.submitted_at).replace(minute=0, second=0, microsecond=0)
+        group = groups.setdefault((hour, row.document_type), ([], []))
+        group[0].append(flt(row.processing_time))
+        if row.time_to_first_byte is not None:
+            group[1].append(flt(row.time_to_first_byte))
+
+    rollup = []
+    for (hour, doctype), (processing, ttfb) in sorted(groups.items()):
+        processing.sort()
+        ttfb.sort()
+        rollup.append({
+            "hour": hour,
+            "document_type": doctype,
+            "count": len(processing),
+            "p50": percentile(processing, 50),
+            "p95": percentile(processing, 95),
+            "p99": percentile(processing, 99),
+            "ttfb_p50": percentile(ttfb, 50),
+            "ttfb_p95": percentile(ttfb, 95),
+            "ttfb_p99": percentile(ttfb, 99),
+        })
+    return rollup
@@ -1,9 +1,16 @@
 # Copyright (c) 2025, osama.ahmed@deliverydevs.com and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class FBRLogs(Document):
 	pass
+
+
+def on_doctype_update():
+	# Latency rollups read submitted_at ranges
+	frappe.db.add_index("FBR Logs", ["submitted_at"])
+	# Submission history of one invoice
+	frappe.db.add_index("FBR Logs", ["document_type", "document_name"])
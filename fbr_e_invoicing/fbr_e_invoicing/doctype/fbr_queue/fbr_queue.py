@@ -1,9 +1,26 @@
 # Copyright (c) 2025, osama.ahmed@deliverydevs.com and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
+from frappe.utils import now
 
 
 class FBRQueue(Document):
-	pass
+	def before_insert(self):
+		# Rows are only claimed once next_retry_at is due; NULL never is
+		if not self.next_retry_at:
+			self.next_retry_at = now()
+
+
+def on_doctype_update():
+	# Duplicate check in add_to_queue / enqueue_on_submit
+	frappe.db.add_index("FBR Queue", ["document_type", "document_name", "status"])
+	# Claim order of Pending rows
+	frappe.db.add_index("FBR Queue", ["status", "priority", "created_at"])
+	# Backoff scheduler picks due rows by status and next_retry_at
+	frappe.db.add_index("FBR Queue", ["status", "next_retry_at"])
+	# Lease reaper looks for Processing rows with an expired lease
+	frappe.db.add_index("FBR Queue", ["status", "lease_expires_at"])
+	# Daily archive job walks Completed rows in completed_at order
+	frappe.db.add_index("FBR Queue", ["status", "completed_at"])
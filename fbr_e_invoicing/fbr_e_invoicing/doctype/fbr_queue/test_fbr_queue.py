@@ -4,6 +4,9 @@
 # import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from fbr_e_invoicing.api.query_plans import get_full_scans
+
 
 class TestFBRQueue(FrappeTestCase):
-	pass
+	def test_hot_queries_use_indexes(self):
+		self.assertEqual(get_full_scans(), [])
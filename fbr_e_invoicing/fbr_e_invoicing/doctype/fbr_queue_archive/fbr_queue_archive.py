@@ -0,0 +1,14 @@
+# Copyright (c) 2026, osama.ahmed@deliverydevs.com and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class FBRQueueArchive(Document):
+	pass
+
+
+def on_doctype_update():
+	# Archived submissions are looked up per invoice
+	frappe.db.add_index("FBR Queue Archive", ["document_type", "document_name"])
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, osama.ahmed@deliverydevs.com and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("FBR Submission Rollup", {
+// 	refresh(frm) {
+
+// 	},
+// });
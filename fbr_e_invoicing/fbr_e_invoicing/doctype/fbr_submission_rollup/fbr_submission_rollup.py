@@ -0,0 +1,14 @@
+# Copyright (c) 2026, osama.ahmed@deliverydevs.com and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class FBRSubmissionRollup(Document):
+	pass
+
+
+def on_doctype_update():
+	# Stats read day ranges
+	frappe.db.add_index("FBR Submission Rollup", ["day", "document_type"])
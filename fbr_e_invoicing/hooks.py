@@ -11,11 +11,49 @@ app_license = "mit"
 
 doc_events = {
 	"POS Invoice": {
-		"after_insert": "fbr_e_invoicing.api.pos_invoice_build_payload.get"
+		# Runs after the controller's validate has settled rates, taxes and defaults
+		"validate": "fbr_e_invoicing.api.pos_invoice_build_payload.set_payload",
+		"after_insert": "fbr_e_invoicing.api.pos_invoice_build_payload.get",
+		"on_submit": "fbr_e_invoicing.api.fbr_queue.enqueue_on_submit",
+		"on_cancel": "fbr_e_invoicing.api.fbr_queue.cancel_queued_submission"
 	},
 	"Sales Invoice": {
 		"validate": "fbr_e_invoicing.api.fbr_validation.validate_fbr_fields",
-		"before_submit": "fbr_e_invoicing.api.fbr_validation.force_today_posting_date"
+		# The payload is frozen after the posting date is forced to today
+		"before_submit": [
+			"fbr_e_invoicing.api.fbr_validation.force_today_posting_date",
+			"fbr_e_invoicing.api.build_fbr_payload.freeze_fbr_payload"
+		],
+		"on_submit": "fbr_e_invoicing.api.fbr_queue.enqueue_on_submit",
+		"on_cancel": "fbr_e_invoicing.api.fbr_queue.cancel_queued_submission"
+	},
+	# Keep the cached tax rates used by the payload builders in sync
+	"Item Tax Template": {
+		"on_update": "fbr_e_invoicing.api.fbr_cache.clear_item_tax_rate_cache",
+		"on_trash": "fbr_e_invoicing.api.fbr_cache.clear_item_tax_rate_cache",
+		"after_rename": "fbr_e_invoicing.api.fbr_cache.clear_item_tax_rate_cache"
+	},
+	# Party addresses are linked through the Address's Dynamic Link rows
+	"Address": {
+		"on_update": "fbr_e_invoicing.api.fbr_cache.clear_party_address_cache",
+		"on_trash": "fbr_e_invoicing.api.fbr_cache.clear_party_address_cache",
+		"after_rename": "fbr_e_invoicing.api.fbr_cache.clear_party_address_cache"
+	},
+	# Party fields checked by validation and read by the payload builders
+	"Customer": {
+		"on_update": "fbr_e_invoicing.api.fbr_cache.clear_party_fields_cache",
+		"on_trash": "fbr_e_invoicing.api.fbr_cache.clear_party_fields_cache",
+		"after_rename": "fbr_e_invoicing.api.fbr_cache.clear_party_fields_cache"
+	},
+	"Company": {
+		"on_update": "fbr_e_invoicing.api.fbr_cache.clear_party_fields_cache",
+		"on_trash": "fbr_e_invoicing.api.fbr_cache.clear_party_fields_cache",
+		"after_rename": "fbr_e_invoicing.api.fbr_cache.clear_party_fields_cache"
+	},
+	"FBR Sale Type": {
+		"on_update": "fbr_e_invoicing.api.fbr_cache.clear_sale_type_cache",
+		"on_trash": "fbr_e_invoicing.api.fbr_cache.clear_sale_type_cache",
+		"after_rename": "fbr_e_invoicing.api.fbr_cache.clear_sale_type_cache"
 	}
 }
 
@@ -23,16 +61,24 @@ doc_events = {
 # ---------------
 
 scheduler_events = {
-	# Process FBR queue every 15 minutes
+	# Sweep the FBR queue every 15 minutes; submitted invoices are pushed on submit
 	"cron": {
 		"*/15 * * * *": [
 			"fbr_e_invoicing.api.fbr_queue.process_fbr_queue_scheduled"
+		],
+		# Return rows abandoned by dead workers to the queue
+		"*/5 * * * *": [
+			"fbr_e_invoicing.api.fbr_queue.requeue_expired_leases"
+		],
+		# Write out FBR Logs rows still waiting in the buffer
+		"* * * * *": [
+			"fbr_e_invoicing.api.log_buffer.flush_log_buffer"
 		]
 	},
-	# Cleanup old logs and queue items daily at 2 AM
-	# "daily": [
-	# 	"fbr_e_invoicing.api.fbr_maintenance.cleanup_old_records"
-	# ],
+	# Move completed queue rows to FBR Queue Archive
+	"daily": [
+		"fbr_e_invoicing.api.fbr_queue.archive_completed_queue_items"
+	],
 	# Generate FBR reports weekly
 	# "weekly": [
 	# 	"fbr_e_invoicing.api.fbr_reports.generate_weekly_report"
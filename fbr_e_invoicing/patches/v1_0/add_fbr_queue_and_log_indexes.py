@@ -0,0 +1,8 @@
+from fbr_e_invoicing.fbr_e_invoicing.doctype.fbr_logs.fbr_logs import on_doctype_update as add_fbr_logs_indexes
+from fbr_e_invoicing.fbr_e_invoicing.doctype.fbr_queue.fbr_queue import on_doctype_update as add_fbr_queue_indexes
+def execute():
+    # on_doctype_update only runs when the doctype itself is reloaded, so
+    # create the indexes on sites whose FBR Queue / FBR Logs are unchanged.
+    # add_index skips indexes that already exist.
+    add_fbr_queue_indexes()
+    add_fbr_logs_indexes()
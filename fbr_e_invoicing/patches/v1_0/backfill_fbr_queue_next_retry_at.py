@@ -0,0 +1,9 @@
+import frappe
+def execute():
+    # Rows queued before the backoff scheduler have no next_retry_at and
+    # would never be picked up; make them due immediately.
+    frappe.db.sql("""
+        UPDATE `tabFBR Queue`
+        SET next_retry_at = IFNULL(created_at, creation)
+        WHERE next_retry_at IS NULL AND status IN ('Pending', 'Failed')
+    """)
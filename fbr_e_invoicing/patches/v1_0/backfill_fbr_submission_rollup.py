@@ -0,0 +1,19 @@
+import frappe
+def execute():
+    # Seed the daily rollup from FBR Logs written before it existed; new
+    # rows are added by the log writer.
+    frappe.db.sql("DELETE FROM `tabFBR Submission Rollup`")
+    frappe.db.sql("""
+        INSERT INTO `tabFBR Submission Rollup`
+            (name, creation, modified, owner, modified_by, day, document_type, status,
+             submission_count, timed_count, total_processing_time, ttfb_count, total_time_to_first_byte)
+        SELECT
+            CONCAT(DATE(submitted_at), '-', document_type, '-', status),
+            NOW(), NOW(), 'Administrator', 'Administrator',
+            DATE(submitted_at), document_type, status,
+            COUNT(*), COUNT(processing_time), IFNULL(SUM(processing_time), 0),
+            COUNT(time_to_first_byte), IFNULL(SUM(time_to_first_byte), 0)
+        FROM `tabFBR Logs`
+        WHERE submitted_at IS NOT NULL
+        GROUP BY DATE(submitted_at), document_type, status
+    """)
@@ -0,0 +1,9 @@
+import frappe
+def execute():
+    # Rows left in Processing before leases existed have no lease_expires_at;
+    # expire them so the lease reaper returns them to Pending.
+    frappe.db.sql("""
+        UPDATE `tabFBR Queue`
+        SET lease_expires_at = %s
+        WHERE status = 'Processing' AND lease_expires_at IS NULL
+    """, frappe.utils.now())
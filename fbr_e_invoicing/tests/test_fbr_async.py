@@ -0,0 +1,94 @@
+# Copyright (c) 2025, osama.ahmed@deliverydevs.com and Contributors
+# See license.txt
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from fbr_e_invoicing.api.fbr_async import submit_batch_async
+
+
+class StubFBRHandler(BaseHTTPRequestHandler):
+	in_flight = 0
+	max_in_flight = 0
+	lock = threading.Lock()
+
+	def do_POST(self):
+		cls = type(self)
+		with cls.lock:
+			cls.in_flight += 1
+			cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+
+		body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+		time.sleep(0.05)
+
+		with cls.lock:
+			cls.in_flight -= 1
+
+		data = json.dumps({
+			"invoiceNumber": f"FBR-{body['invoiceRefNo']}",
+			"validationResponse": {"status": "Valid"},
+		}).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, *args):
+		pass
+
+
+class TestSubmitBatchAsync(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubFBRHandler)
+		cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+		cls.thread.start()
+		cls.endpoint = f"http://127.0.0.1:{cls.server.server_port}/di_data/v1/di/postinvoicedata"
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+		StubFBRHandler.max_in_flight = 0
+
+	def test_returns_responses_in_input_order(self):
+		items = [{"key": f"Q-{i}", "body": json.dumps({"invoiceRefNo": str(i)})} for i in range(12)]
+
+		with requests.Session() as session:
+			results = submit_batch_async(items, session, self.endpoint, concurrency=4)
+
+		self.assertEqual([key for key, _ in results], [item["key"] for item in items])
+		for i, (_, resp) in enumerate(results):
+			self.assertEqual(resp.status_code, 200)
+			self.assertEqual(resp.json()["invoiceNumber"], f"FBR-{i}")
+			self.assertGreaterEqual(resp.total_seconds, 0.05)
+
+	def test_concurrency_is_bounded(self):
+		items = [{"key": i, "body": json.dumps({"invoiceRefNo": str(i)})} for i in range(16)]
+
+		with requests.Session() as session:
+			submit_batch_async(items, session, self.endpoint, concurrency=3)
+
+		self.assertLessEqual(StubFBRHandler.max_in_flight, 3)
+		self.assertGreater(StubFBRHandler.max_in_flight, 1)
+
+	def test_transport_errors_are_returned_not_raised(self):
+		items = [{"key": "Q-1", "body": json.dumps({"invoiceRefNo": "1"})}]
+
+		with requests.Session() as session:
+			results = submit_batch_async(items, session, "http://127.0.0.1:1/", concurrency=2, timeout=(0.5, 0.5))
+
+		self.assertEqual(results[0][0], "Q-1")
+		self.assertIsInstance(results[0][1], requests.RequestException)
+
+	def test_empty_batch(self):
+		self.assertEqual(submit_batch_async([], None, self.endpoint), [])
+
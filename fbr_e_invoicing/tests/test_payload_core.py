@@ -0,0 +1,85 @@
+# Copyright (c) 2025, osama.ahmed@deliverydevs.com and Contributors
+# See license.txt
+
+import datetime
+import json
+import pickle
+import unittest
+
+from fbr_e_invoicing.api import payload_core
+from fbr_e_invoicing.api.payload_core import (
+	InvoiceRecord,
+	LineRecord,
+	build_payload,
+	build_payloads,
+	canonical_json,
+	get_buyer_tax_id,
+	get_invoice_scenario_id,
+	normalise_cnic,
+	payload_hash,
+)
+
+
+def make_record(i):
+	return InvoiceRecord(
+		"Sales Invoice",
+		f"ACC-SINV-{i:05d}",
+		{"posting_date": datetime.date(2026, 10, 17), "company": "Delivery Devs", "is_debit_note": 0},
+		{"seller_tax_id": "1234567", "buyer_tax_id": "7654321", "buyer_name": "ACME", "scenario_id": "SN001"},
+		[
+			LineRecord(tax_rate=18.0, custom_hs_code="0101.2100", item_name="Widget", qty=i, rate=100),
+			LineRecord(tax_rate=0.0, item_name="Exempt", qty=1, rate=50, parent="ignored"),
+		],
+	)
+
+
+class TestPartyResolution(unittest.TestCase):
+	def test_normalise_cnic(self):
+		self.assertEqual(normalise_cnic(" 31303-9589654-7 "), "3130395896547")
+		self.assertEqual(normalise_cnic(None), "")
+
+	def test_buyer_tax_id_precedence(self):
+		self.assertEqual(get_buyer_tax_id("111", "31303-9589654-7", "222"), "111")
+		self.assertEqual(get_buyer_tax_id(None, "31303-9589654-7", "222"), "3130395896547")
+		self.assertEqual(get_buyer_tax_id(None, None, "222"), "222")
+
+	def test_invoice_scenario_is_first_known_line(self):
+		self.assertEqual(get_invoice_scenario_id(["", "SN019", "SN001"]), "SN019")
+		self.assertEqual(get_invoice_scenario_id([]), "")
+
+
+class TestBuildPayloads(unittest.TestCase):
+	def test_build_payload(self):
+		name, payload = build_payload(make_record(2))
+
+		self.assertEqual(name, "ACC-SINV-00002")
+		self.assertEqual(payload["invoiceType"], "Sale Invoice")
+		self.assertEqual(payload["buyerRegistrationType"], "Registered")
+		self.assertEqual([item["salesTaxApplicable"] for item in payload["items"]], [18.0, 0.0])
+		self.assertEqual([item["rate"] for item in payload["items"]], ["18%", "0%"])
+
+	def test_records_pickle(self):
+		record = pickle.loads(pickle.dumps(make_record(3)))
+
+		self.assertEqual(build_payload(record), build_payload(make_record(3)))
+
+	def test_process_pool_matches_serial(self):
+		records = [make_record(i) for i in range(payload_core.MIN_PARALLEL_INVOICES)]
+
+		self.assertEqual(build_payloads(records, processes=2), build_payloads(records))
+
+
+class TestCanonicalJson(unittest.TestCase):
+	def test_key_order_does_not_change_bytes(self):
+		a = {"items": [{"rate": "18%", "quantity": 1.5}], "invoiceType": "Sale Invoice"}
+		b = {"invoiceType": "Sale Invoice", "items": [{"quantity": 1.5, "rate": "18%"}]}
+
+		self.assertEqual(canonical_json(a), canonical_json(b))
+		self.assertEqual(payload_hash(canonical_json(a)), payload_hash(canonical_json(b)))
+
+	def test_stored_body_round_trips(self):
+		body = canonical_json({"buyerBusinessName": "Café Lahore", "valueSalesExcludingST": 0.1 + 0.2})
+
+		self.assertNotIn(", ", body)
+		self.assertNotIn(": ", body)
+		self.assertEqual(canonical_json(json.loads(body)), body)
@@ -0,0 +1,105 @@
+# Copyright (c) 2025, osama.ahmed@deliverydevs.com and Contributors
+# See license.txt
+
+import datetime
+import unittest
+
+from fbr_e_invoicing.api.payload_mapping import (
+	POS_INVOICE,
+	SALES_INVOICE,
+	Const,
+	Ctx,
+	Field,
+	benchmark,
+	compile_projection,
+)
+
+
+ITEM = {
+	"custom_hs_code": "0101.2100",
+	"description": None,
+	"item_name": "Widget",
+	"stock_uom": "Nos",
+	"uom": "Box",
+	"qty": "3",
+	"rate": 1000,
+	"discount_amount": -12.5,
+	"custom_sale_type": "Goods at standard rate (default)",
+}
+
+
+class TestCompileProjection(unittest.TestCase):
+	def test_sources(self):
+		project = compile_projection((
+			("a", Field("x")),
+			("b", Field("x", fallbacks=("y",))),
+			("c", Field("n", "float")),
+			("d", Ctx("k")),
+			("e", Const(0.0)),
+		))
+
+		self.assertEqual(
+			project({"y": "fallback", "n": None}, {"k": "ctx"}),
+			{"a": "", "b": "fallback", "c": 0.0, "d": "ctx", "e": 0.0},
+		)
+
+
+class TestInvoiceMappings(unittest.TestCase):
+	def test_sales_invoice(self):
+		header = {
+			"posting_date": datetime.date(2026, 10, 17),
+			"company": "Delivery Devs",
+			"custom_province": "Punjab",
+			"tax_category": "Sindh",
+			"is_debit_note": 1,
+		}
+		ctx = {"seller_tax_id": "1234567", "buyer_tax_id": None, "buyer_name": "ACME", "scenario_id": "SN001"}
+
+		payload = SALES_INVOICE.build(header, ctx, [ITEM], [{"tax_rate": 18.0}])
+
+		self.assertEqual(payload["invoiceType"], "Debit Note")
+		self.assertEqual(payload["invoiceDate"], "2026-10-17")
+		self.assertEqual(payload["sellerAddress"], "")
+		self.assertEqual(payload["buyerRegistrationType"], "Unregistered")
+		self.assertEqual(payload["scenarioId"], "SN001")
+		self.assertEqual(payload["items"], [{
+			"hsCode": "0101.2100",
+			"productDescription": "Widget",
+			"rate": "18%",
+			"uoM": "Nos",
+			"quantity": 3.0,
+			"totalValues": 0.0,
+			"valueSalesExcludingST": 1000.0,
+			"fixedNotifiedValueOrRetailPrice": 0.0,
+			"salesTaxApplicable": 180.0,
+			"salesTaxWithheldAtSource": 0.0,
+			"extraTax": 0.0,
+			"furtherTax": 0.0,
+			"sroScheduleNo": "",
+			"fedPayable": 0.0,
+			"discount": 12.5,
+			"saleType": "Goods at standard rate (default)",
+			"sroItemSerialNo": "",
+		}])
+
+	def test_pos_invoice(self):
+		payload = POS_INVOICE.build(
+			{"posting_date": "2026-10-17", "tax_category": "Sindh"},
+			{"seller_name": "Walk-in", "buyer_tax_id": "7654321", "buyer_name": "Delivery Devs"},
+			[ITEM],
+			[{"tax_rate": 17.5}],
+		)
+
+		self.assertEqual(payload["invoiceType"], "POS Invoice")
+		self.assertEqual(payload["sellerProvince"], "Sindh")
+		self.assertEqual(payload["buyerRegistrationType"], "Registered")
+		self.assertNotIn("scenarioId", payload)
+		self.assertEqual(payload["items"][0]["rate"], "17.5%")
+		self.assertEqual(payload["items"][0]["uoM"], "Box")
+		self.assertEqual(payload["items"][0]["saleType"], "Goods at standard rate (default)")
+
+	def test_benchmark_reports_per_line_cost(self):
+		results = benchmark(lines=100, repeat=1)
+
+		self.assertEqual(set(results), {"Sales Invoice", "POS Invoice"})
+		self.assertTrue(all(cost > 0 for cost in results.values()))
@@ -1,6 +1,7 @@
 import frappe
 import requests
 import os
+from fbr_e_invoicing.api.fbr_cache import clear_sale_type_cache
 
 
 def sync_hs_codes():
@@ -162,6 +163,8 @@ def create_fbr_sale_types():
             frappe.logger().error(f"Error creating FBR Sale Type {sale_type['name']}: {str(e)}")
     
     frappe.db.commit()
+    # set_value above bypasses the FBR Sale Type hooks
+    clear_sale_type_cache()
     frappe.logger().info("FBR Sale Types populated successfully")
 
     
\ No newline at end of file